@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+'''
+Compares requests/sec of the asyncio download engine, with aiohttp and with the thread pool it falls back to when
+aiohttp is not installed, against the old per-phase ThreadPoolExecutor path.
+All run against a local stand-in server so no traffic goes to matterport.
+Usage: bench_download.py [requests] [latency_ms] [payload_bytes]
+'''
+
+import asyncio
+import concurrent.futures
+import importlib.util
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def loadDownloader():
+    spec = importlib.util.spec_from_file_location("matterport_dl", os.path.join(ROOT, "matterport-dl.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class StandInServer:
+    '''
+    Minimal keep-alive HTTP/1.1 server answering every GET with the same payload after a fixed delay.
+    '''
+
+    def __init__(self, latency_ms=20, payload_bytes=16 * 1024):
+        self.latency = latency_ms / 1000
+        self.payload = os.urandom(payload_bytes)
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+        threading.Thread(target=self._serve, daemon=True).start()
+        self.ready.wait()
+
+    def _serve(self):
+        asyncio.set_event_loop(self.loop)
+        server = self.loop.run_until_complete(asyncio.start_server(self._handle, "127.0.0.1", 0, backlog=4096))
+        self.port = server.sockets[0].getsockname()[1]
+        self.ready.set()
+        self.loop.run_forever()
+
+    async def _handle(self, reader, writer):
+        header = b"HTTP/1.1 200 OK\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n" % len(self.payload)
+        try:
+            while await reader.readuntil(b"\r\n\r\n"):
+                await asyncio.sleep(self.latency)
+                writer.write(header + self.payload)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.port}/{path}"
+
+
+def jobsFor(server, count):
+    return [(server.url(f"tiles/{i // 510}/{i % 510}.jpg?t=x"), f"tiles/{i // 510}/{i % 510}.jpg") for i in range(count)]
+
+
+def threadedDownload(jobs):
+    # What every phase did before the engine: a shared requests session behind a 32 thread executor
+    session = requests.Session()
+
+    def fetch(url, file):
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        if os.path.exists(file):
+            return
+        response = session.get(url)
+        response.raise_for_status()
+        with open(file, 'wb') as f:
+            f.write(response.content)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=32) as executor:
+        for url, file in jobs:
+            executor.submit(fetch, url, file)
+
+
+def timeIt(name, func, jobs):
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            start = time.perf_counter()
+            func(jobs)
+            elapsed = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+    print(f"{name:>10}: {len(jobs)} requests in {elapsed:.2f}s = {len(jobs) / elapsed:.0f} req/s")
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    latency_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 20
+    payload_bytes = int(sys.argv[3]) if len(sys.argv) > 3 else 16 * 1024
+    mpdl = loadDownloader()
+    mpdl.logging.getLogger().setLevel("ERROR")
+    server = StandInServer(latency_ms, payload_bytes)
+    jobs = jobsFor(server, count)
+    print(f"Stand-in server on port {server.port}, {latency_ms}ms latency, {payload_bytes} byte responses")
+    timeIt("threaded", threadedDownload, jobs)
+    timeIt("asyncio", mpdl.downloadFiles, jobs)
+    mpdl.getEngine().close()
+    # a fresh engine without aiohttp, as a run with only requirements.txt installed gets
+    mpdl.DOWNLOAD_ENGINE = None
+    mpdl.aiohttp = None
+    timeIt("fallback", mpdl.downloadFiles, jobs)
+    mpdl.getEngine().close()
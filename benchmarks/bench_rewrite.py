@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+'''
+Checks that rewriting is idempotent and times the rewriters.
+Every showcase.*.js, index.html and graph_*.json found under downloads/ (or showcase bundles given on the command line)
+is rewritten twice with the rewriter the downloader uses for it, and the second pass has to find nothing.  Archived
+files are already patched, so each showcase bundle is also run with the patches undone and the original strings put
+back, including ones that only match across a replacement ('"https://static.matterport.com/api/mp/' turns into a
+'"/api/mp/' for api-path once static-host has run).
+Usage: bench_rewrite.py [iterations] [showcase.js ...]
+'''
+
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_download import ROOT, loadDownloader  # noqa: E402
+
+# Originals as they appear in an unpatched bundle, the first two only match once another rule has run
+UNPATCHED_SNIPPETS = [
+    'fetch("https://static.matterport.com/api/mp/models/graph",{})',
+    'url:"https://static.matterport.com/api/mp/accounts/session"',
+    'if(e.token&&(!e.expires||1e3*e.expires>Date.now()))return e.token',
+    'const t=`${this.baseUrl}/api/v1/event`',
+    'e.get("https://static.matterport.com/geoip/",{responseType:"json",priority:i.RequestPriority.LOW})',
+    'n.p="https://static.matterport.com/showcase/"',
+]
+
+
+def unpatch(mpdl, text):
+    # Undo the literal rules whose replacement can be told apart from the rest of the bundle
+    for _, pattern, replacement in mpdl.SHOWCASE_REWRITER.rules:
+        if isinstance(pattern, str) and replacement:
+            text = text.replace(replacement, pattern)
+    step = max(len(text) // len(UNPATCHED_SNIPPETS), 1)
+    parts = []
+    for index, snippet in enumerate(UNPATCHED_SNIPPETS):
+        parts.append(text[index * step:(index + 1) * step])
+        parts.append(";" + snippet + ";")
+    parts.append(text[len(UNPATCHED_SNIPPETS) * step:])
+    return "".join(parts)
+
+
+def fixtures(mpdl, showcases):
+    for file in showcases:
+        with open(file, encoding="UTF-8") as f:
+            text = f.read()
+        yield os.path.relpath(file, ROOT), mpdl.SHOWCASE_REWRITER, text
+        yield os.path.relpath(file, ROOT) + " (unpatched)", mpdl.SHOWCASE_REWRITER, unpatch(mpdl, text)
+    for file in sorted(glob.glob(os.path.join(ROOT, "downloads", "*", "index.html"))):
+        with open(file, encoding="UTF-8") as f:
+            text = f.read()
+        pageid = os.path.basename(os.path.dirname(file))
+        rewriter = mpdl.indexRewriter(pageid, "https://static.matterport.com/showcase/25.11.1-0-g0000000/", "https://static.matterport.com/webgl-vendors/three/0.171.0/three.module.min.js")
+        yield os.path.relpath(file, ROOT), rewriter, text
+    for file in sorted(glob.glob(os.path.join(ROOT, "downloads", "*", "api", "mp", "models", "graph_*.json"))):
+        with open(file, encoding="UTF-8") as f:
+            text = f.read()
+        yield os.path.relpath(file, ROOT), mpdl.GRAPH_REWRITER, text
+
+
+def check(rewriter, text):
+    once, counts = rewriter.rewrite(text)
+    twice, again = rewriter.rewrite(once)
+    assert not again and twice == once, f"second rewrite still matched {dict(again)}"
+    return counts
+
+
+def timed(rewriter, text, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        rewriter.rewrite(text)
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    mpdl = loadDownloader()
+    showcases = sys.argv[2:] or sorted(glob.glob(os.path.join(ROOT, "downloads", "*", "js", "showcase.*.js")))
+    checked = 0
+    for name, rewriter, text in fixtures(mpdl, showcases):
+        counts = check(rewriter, text)
+        checked += 1
+        if rewriter is mpdl.GRAPH_REWRITER:
+            continue  # small files, checked but not worth timing
+        matched = ", ".join(f"{rule} x{count}" for rule, count in counts.items()) or "nothing"
+        print(f"{name}: {len(text) / 1e6:.2f}MB, {timed(rewriter, text, iterations) * 1000:.2f}ms per rewrite, matched {matched}")
+    if not checked:
+        print("No archived files found under downloads/, pass a showcase.js to check")
+        return 1
+    print(f"{checked} files rewrite idempotently")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
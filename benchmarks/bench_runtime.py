@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+'''
+Checks and times parseRuntime against the regex based parser it replaced.
+Every runtime~showcase.*.js found under downloads/ (or given on the command line) is parsed, plus fixtures rendering
+the same chunk maps the way other showcase builds have: spaced out, quoted keys, other minified names, exponent keys
+and names containing commas.  check() asserts each fixture parses to its known answer and every archived runtime to
+well formed chunks before anything is timed, --check runs only that.  The old parser is only timed.
+Usage: bench_runtime.py [--check] [iterations] [runtime.js ...]
+'''
+
+import glob
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_download import ROOT, loadDownloader  # noqa: E402
+
+
+def oldParseRuntime(content):
+    # The parser as it was before the tokenizer, kept here as the baseline
+    def pairs(text):
+        found = {}
+        for pair in text.split(','):
+            if ':' in pair:
+                k, v = pair.split(':')
+                found[k.strip()] = v.strip('"')
+        return found
+
+    match = re.search(r'n\.u=e=>"js/"\+\(({.*?)}\[e\]\|\|e\)', content)
+    name_map = pairs(match.group(1)) if match else {}
+    match = re.search(r'\+\s*["\']\.["\']\s*\+\s*({.*?})\s*\[e\]\s*\+\s*["\']\.js["\']', content, re.DOTALL)
+    if not match:
+        match = re.search(r'({[\w\d]+:"[a-f0-9]+".*?})\[e\]\+"\.js"', content, re.DOTALL)
+    hash_map = pairs(match.group(1).strip('{}')) if match else {}
+    js_chunks = [(chunk_id, name_map.get(chunk_id, chunk_id), chunk_hash) for chunk_id, chunk_hash in hash_map.items()]
+
+    match = re.search(r'n\.miniCssF=e=>"css/"\+\(({.*?)}\[e\]\|\|e\)\+"\.css"', content)
+    css_names = pairs(match.group(1)) if match else {}
+    match = re.search(r'n\.f\.miniCss=.*?\s*({[\d:,]+})\s*\[r\]', content, re.DOTALL)
+    css_chunks = [css_names.get(chunk_id, chunk_id) for chunk_id in pairs(match.group(1).strip('{}'))] if match else []
+    return js_chunks, css_chunks or list(css_names.values())
+
+
+def literal(mapping, key=str, value=lambda v: f'"{v}"', sep=","):
+    return "{" + sep.join(f"{key(k)}:{value(v)}" for k, v in mapping.items()) + "}"
+
+
+def render(names, hashes, css_names, css_ids, style):
+    '''
+    Builds a runtime with the given maps, style picks the formatting quirks.
+    '''
+    key = {"quoted": lambda k: f'"{k}"', "exponent": lambda k: "5e3" if k == "5000" else k}.get(style, str)
+    sep = ", " if style == "spaced" else ","
+    n, e, r = ("o", "t", "i") if style == "renamed" else ("n", "e", "r")
+    js = (f'{n}.u={e}=>"js/"+({literal(names, key, sep=sep)}[{e}]||{e})+"."+{literal(hashes, key, sep=sep)}[{e}]+".js",'
+          f'{n}.miniCssF={e}=>"css/"+({literal(css_names, key, sep=sep)}[{e}]||{e})+".css",')
+    css = (f'{n}.f.miniCss=({r},a)=>{{t[{r}]?a.push(t[{r}]):0!==t[{r}]&&{literal({i: 1 for i in css_ids}, key, str, sep)}[{r}]'
+           f'&&a.push(t[{r}]=s({r}).then((()=>{{t[{r}]=0}}),(x=>{{throw delete t[{r}],x}})))}}')
+    if style == "spaced":
+        js = js.replace("=>", " => ").replace('+', ' + ')
+    return f'(()=>{{"use strict";var {n}={{}};{n}.m={{}},{js}{n}.g=function(){{return this}}(),(()=>{{var t={{}};{css}}})()}})();'
+
+
+def fixtures(runtime_files):
+    for file in runtime_files:
+        with open(file, "r", encoding="UTF-8") as f:
+            yield os.path.relpath(file, ROOT), f.read(), None
+    names = {"239": "three-examples", "777": "split", "5385": "init", "9114": "core"}
+    hashes = {"235": "ebe436e0767511a988c6", "239": "43ff9a20c059474dffba", "777": "ead803f95beda385d062",
+              "5000": "cd28576f1cd225bfd790", "5385": "8cf1009afb05f45d4018", "9114": "5c28422af67a909460f5"}
+    css_names = {"5385": "init", "9114": "core"}
+    css_ids = ["1442", "5385", "9114"]
+    for style in ("plain", "spaced", "quoted", "renamed", "exponent"):
+        expected = ([(k, names.get(k, k), v) for k, v in hashes.items()], [css_names.get(i, i) for i in css_ids])
+        yield f"fixture:{style}", render(names, hashes, css_names, css_ids, style), expected
+    # names holding commas and colons, which splitting the captured literal on , and : cannot handle
+    odd = dict(names, **{"777": "split,late:stream"})
+    expected = ([(k, odd.get(k, k), v) for k, v in hashes.items()], [css_names.get(i, i) for i in css_ids])
+    yield "fixture:punctuation", render(odd, hashes, css_names, css_ids, "plain"), expected
+    # a much bigger build, to see how both scale
+    many = {str(i * 7): f"{i * 2654435761 % 2 ** 80:020x}" for i in range(1, 3000)}
+    many_names = {k: f"chunk-{k}" for k in list(many)[::10]}
+    expected = ([(k, many_names.get(k, k), v) for k, v in many.items()], [many_names.get(i, i) for i in list(many)[::5]])
+    yield "fixture:large", render(many_names, many, many_names, list(many)[::5], "plain"), expected
+
+
+def timed(parse, content, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        parse(content)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def check(mdl, runtime_files):
+    '''
+    Asserts parseRuntime finds exactly the expected chunks in every fixture, and in archived runtimes, which have no
+    known answer, js chunks with unique names and webpack content hashes plus some css chunks.
+    '''
+    checked = 0
+    for name, content, expected in fixtures(runtime_files):
+        js_chunks, css_chunks = mdl.parseRuntime(content)
+        if expected is not None:
+            assert js_chunks == expected[0], f"{name}: js chunks {js_chunks} != {expected[0]}"
+            assert css_chunks == expected[1], f"{name}: css chunks {css_chunks} != {expected[1]}"
+        else:
+            assert js_chunks and css_chunks, f"{name}: found {len(js_chunks)} js and {len(css_chunks)} css chunks"
+            assert len({chunk_name for _, chunk_name, _ in js_chunks}) == len(js_chunks), f"{name}: duplicate chunk names"
+            for chunk_id, chunk_name, chunk_hash in js_chunks:
+                assert re.fullmatch(r"[0-9a-f]{20}", chunk_hash), f"{name}: chunk {chunk_id} ({chunk_name}) has hash {chunk_hash!r}"
+        checked += 1
+    return checked
+
+
+def main():
+    args = sys.argv[1:]
+    check_only = "--check" in args
+    if check_only:
+        args.remove("--check")
+    iterations = int(args[0]) if args else 2000
+    runtime_files = args[1:] or sorted(glob.glob(os.path.join(ROOT, "downloads", "*", "js", "runtime~showcase.*.js")))
+    mdl = loadDownloader()
+    print(f"parseRuntime gives the expected chunks for {check(mdl, runtime_files)} runtimes")
+    if check_only:
+        return
+    print(f"{'runtime':<60} {'js':>4} {'css':>4} {'old':>6} {'new µs':>8} {'old µs':>8}")
+    for name, content, expected in fixtures(runtime_files):
+        js_chunks, css_chunks = mdl.parseRuntime(content)
+        old_js, old_css = oldParseRuntime(content)
+        old_ok = "same" if (old_js, old_css) == (js_chunks, css_chunks) else "diff"
+        print(f"{name[-60:]:<60} {len(js_chunks):>4} {len(css_chunks):>4} {old_ok:>6} "
+              f"{timed(mdl.parseRuntime, content, iterations):8.1f} {timed(oldParseRuntime, content, iterations):8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+'''
+Loads the replay server the way viewers opening a tour do and reports time to first frame and tiles/sec.
+A copy of an archive gets synthetic sweep tiles, then every viewer fetches index.html, the showcase bundle and runtime
+and the graph queries, then the six 512 faces of its first sweep (its first frame) and then every tile of its sweeps,
+over a browser's handful of kept-alive connections.  The threaded HTTP/1.1 server, with and without its response
+cache, is run against the single-threaded HTTP/1.0 one it replaced, each in its own process.
+Usage: bench_serve.py [--viewers 8] [--connections 6] [--sweeps 4] [--tile-depth 2k] [--tile-bytes 49152] [--cache-mb 64]
+                      [--modes legacy,threaded,cached] [archive_dir]
+'''
+
+import argparse
+import concurrent.futures
+import glob
+import http.client
+import http.server
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_download import ROOT, loadDownloader  # noqa: E402
+
+GRAPH_OPERATIONS = ["GetModelDetails", "GetModelViewPrefetch", "GetLabels", "GetMattertags"]
+
+
+def buildArchive(mdl, source, scratch, sweeps, tile_depth, tile_bytes):
+    '''
+    Copies the archive and writes tiles for sweeps synthetic sweeps, returns (archive, [tile paths per sweep]).
+    '''
+    archive = os.path.join(scratch, os.path.basename(os.path.abspath(source)))
+    shutil.copytree(source, archive)
+    models = sorted(glob.glob(os.path.join(archive, "models", "*")))
+    model_dir = os.path.relpath(models[0], archive) if models else "models/bench"
+    payload = os.urandom(tile_bytes)
+    tiles = []
+    for sweep in range(sweeps):
+        sweep_dir = f"{model_dir}/tiles/{sweep:032x}"
+        os.makedirs(os.path.join(archive, sweep_dir))
+        paths = []
+        for variant in mdl.getVariants(mdl.TILE_DEPTHS.index(tile_depth)):
+            with open(os.path.join(archive, sweep_dir, variant), "wb") as f:
+                f.write(payload)
+            paths.append(f"/{sweep_dir}/{variant}?t=2-bench-0&imageopt=1")
+        tiles.append(paths)
+    return archive, tiles
+
+
+def serve(mode, archive, port, ready, cache_mb):
+    mdl = loadDownloader()
+    mdl.logging.getLogger().setLevel(mdl.logging.WARNING)
+    mdl.RESPONSE_CACHE_SIZE = int(cache_mb * 1024 * 1024) if mode == "cached" else 0
+    handler = mdl.OurSimpleHTTPRequestHandler
+    handler.log_message = lambda self, *args: None
+    if mode in ("threaded", "cached"):
+        server = mdl.ReplayServer(("127.0.0.1", port), handler)
+    else:
+        class LegacyHandler(handler):
+            protocol_version = "HTTP/1.0"
+        server = http.server.HTTPServer(("127.0.0.1", port), LegacyHandler)
+    mdl.prepareServer(archive)
+    ready.set()
+    server.serve_forever()
+
+
+def freePort():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Viewer:
+    '''
+    One browser tab: a pool of connections, each reused for as long as the server keeps it open.
+    '''
+
+    def __init__(self, port, connections):
+        self.port = port
+        self.local = threading.local()
+        self.pool = concurrent.futures.ThreadPoolExecutor(connections)
+        self.retries = 0
+
+    def fetch(self, path, body=None):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+        headers = {"Accept-Encoding": "gzip, deflate, br"}
+        if body:
+            headers["Content-Type"] = "application/json"
+        for attempt in range(20):
+            try:
+                conn.request("POST" if body else "GET", path, body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+                break
+            except (ConnectionError, http.client.HTTPException):
+                # a full listen backlog resets new connections, browsers retry those
+                conn.close()
+                self.retries += 1
+                time.sleep(0.01 * attempt)
+        else:
+            raise RuntimeError(f"{path}: no response after 20 attempts")
+        if response.status != 200:
+            raise RuntimeError(f"{path}: {response.status}")
+        return len(data)
+
+    def fetchAll(self, requests):
+        return sum(self.pool.map(lambda request: self.fetch(*request), requests))
+
+    def open(self, tiles, showcase, runtime):
+        start = time.perf_counter()
+        self.fetch("/index.html")
+        self.fetchAll([(f"/js/{showcase}",), (f"/js/{runtime}",)] +
+                      [("/api/mp/models/graph", json.dumps({"operationName": op}).encode()) for op in GRAPH_OPERATIONS])
+        first = [path for path in tiles[0] if "/512_face" in path]
+        self.fetchAll([(path,) for path in first])
+        first_frame = time.perf_counter() - start
+        rest = [(path,) for sweep in tiles for path in sweep if path not in first]
+        size = self.fetchAll(rest)
+        return first_frame, len(first) + len(rest), size
+
+    def close(self):
+        self.pool.shutdown()
+
+
+def runMode(mode, archive, tiles, viewers, connections, cache_mb):
+    port = freePort()
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=serve, args=(mode, archive, port, ready, cache_mb), daemon=True)
+    process.start()
+    ready.wait()
+    time.sleep(0.2)
+    showcase = os.path.basename(glob.glob(os.path.join(archive, "js", "showcase.*.js"))[0])
+    runtime = os.path.basename(glob.glob(os.path.join(archive, "js", "runtime~showcase.*.js"))[0])
+    tabs = [Viewer(port, connections) for _ in range(viewers)]
+    try:
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(viewers) as pool:
+            # every viewer starts at a different sweep, as they would in different tours
+            results = list(pool.map(lambda i: tabs[i].open(tiles[i % len(tiles):] + tiles[:i % len(tiles)], showcase, runtime), range(viewers)))
+        elapsed = time.perf_counter() - start
+        if mode == "cached":
+            conn = http.client.HTTPConnection("127.0.0.1", port)
+            conn.request("GET", "/_matterport_dl/cache")
+            cache = json.loads(conn.getresponse().read())
+            conn.close()
+    finally:
+        for tab in tabs:
+            tab.close()
+        process.terminate()
+        process.join()
+    first_frames = sorted(first_frame for first_frame, _, _ in results)
+    served = sum(count for _, count, _ in results)
+    size = sum(size for _, _, size in results)
+    retries = sum(tab.retries for tab in tabs)
+    print(f"{mode:>9}: first frame median {statistics.median(first_frames) * 1000:7.1f}ms worst {first_frames[-1] * 1000:7.1f}ms, "
+          f"{served / elapsed:7.0f} tiles/s, {size / 1024 / 1024 / elapsed:6.1f} MB/s, {elapsed:.2f}s total, {retries} retried")
+    if mode == "cached":
+        print(f"{'':>9}  cache hit rate {cache['hit_rate']:.1%}, {cache['entries']} entries, {cache['bytes'] / 1024 / 1024:.1f} MB held, "
+              f"{cache['bytes_served'] / 1024 / 1024:.1f} MB served from memory, {cache['evictions']} evictions")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("archive", nargs="?", default=os.path.join(ROOT, "downloads", "AxN4GbV5ko7"))
+    parser.add_argument("--viewers", type=int, default=8)
+    parser.add_argument("--connections", type=int, default=6, help="kept-alive connections per viewer, browsers open 6 per host")
+    parser.add_argument("--sweeps", type=int, default=4, help="sweeps every viewer walks through")
+    parser.add_argument("--tile-depth", default="2k")
+    parser.add_argument("--tile-bytes", type=int, default=48 * 1024)
+    parser.add_argument("--cache-mb", type=float, default=64, help="response cache budget of the cached mode")
+    parser.add_argument("--modes", default="legacy,threaded,cached")
+    args = parser.parse_args()
+
+    mdl = loadDownloader()
+    scratch = tempfile.mkdtemp(prefix="bench_serve_")
+    try:
+        archive, tiles = buildArchive(mdl, args.archive, scratch, args.sweeps, args.tile_depth, args.tile_bytes)
+        print(f"{args.viewers} viewers x {args.connections} connections, {args.sweeps} sweeps of {len(tiles[0])} "
+              f"{args.tile_bytes // 1024}KB tiles each")
+        for mode in args.modes.split(","):
+            runMode(mode, archive, tiles, args.viewers, args.connections, args.cache_mb)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
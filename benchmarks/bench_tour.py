@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+'''
+Downloads a whole tour with downloadPage from a local MockMatterport and reports time to complete and throughput,
+so changes to the download path can be measured reproducibly on a machine with no network.
+Usage: bench_tour.py [--sweeps 200] [--latency-ms 20] [--bandwidth 0] [--missing-ratio 0] [--token-ttl 3600]
+                     [--throttle-ratio 0] [--max-connections 256] [--runs 1] [archive_dir]
+'''
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_download import ROOT, loadDownloader  # noqa: E402
+from mock_cdn import MockMatterport  # noqa: E402
+
+
+def runOnce(mdl, mock, workdir):
+    # downloadPage works relative to the current directory, give every run a fresh one with the graph queries in it
+    os.makedirs(workdir)
+    shutil.copytree(os.path.join(ROOT, "graph_posts"), os.path.join(workdir, "graph_posts"))
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    requests_before = mock.stats["requests"]
+    start = time.monotonic()
+    try:
+        mdl.downloadPage(mock.pageid)
+    finally:
+        os.chdir(cwd)
+    elapsed = time.monotonic() - start
+    with open(os.path.join(workdir, "downloads", mock.pageid, mdl.RUN_REPORT_FILE), "r", encoding="UTF-8") as f:
+        report = json.load(f)
+    return elapsed, mock.stats["requests"] - requests_before, report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("archive", nargs="?", default=os.path.join(ROOT, "downloads", "AxN4GbV5ko7"))
+    parser.add_argument("--sweeps", type=int, default=200, help="synthetic sweeps instead of the recorded ones, 0 keeps them")
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--bandwidth", type=int, default=0, help="bytes/s per response, 0 for unlimited")
+    parser.add_argument("--missing-ratio", type=float, default=0.0, help="share of static and cdn files answered with 404")
+    parser.add_argument("--token-ttl", type=int, default=3600, help="seconds a cdn token stays valid")
+    parser.add_argument("--throttle-ratio", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--tile-depth", default="2k")
+    parser.add_argument("--max-connections", type=int, default=256)
+    parser.add_argument("--runs", type=int, default=1)
+    args = parser.parse_args()
+
+    mock = MockMatterport(args.archive, latency_ms=args.latency_ms, bandwidth=args.bandwidth, missing_ratio=args.missing_ratio,
+                          token_ttl=args.token_ttl, throttle_ratio=args.throttle_ratio, sweeps=args.sweeps or None,
+                          tile_depth=args.tile_depth).start()
+    mdl = loadDownloader()
+    mdl.URL_REWRITES = mock.rewrites()
+    mdl.MAX_CONNECTIONS = args.max_connections
+    print(f"Mock tour {mock.pageid}: {len(mock.modeldata['sweeps'])} sweeps, latency {args.latency_ms}ms, "
+          f"{'unlimited' if not args.bandwidth else f'{args.bandwidth} B/s'} bandwidth, {args.missing_ratio:.0%} missing, "
+          f"{args.throttle_ratio:.0%} throttled, tokens valid {args.token_ttl}s")
+
+    scratch = tempfile.mkdtemp(prefix="bench_tour_")
+    try:
+        for run in range(args.runs):
+            elapsed, served, report = runOnce(mdl, mock, os.path.join(scratch, f"run{run}"))
+            print(f"run {run + 1}: {elapsed:.2f}s to complete, {served} requests served, {report['requests']} sent "
+                  f"({report['requests'] / elapsed:.0f} req/s), {report['bytes'] / 1024 / 1024:.1f} MB "
+                  f"({report['bytes'] / 1024 / 1024 / elapsed:.1f} MB/s), {report['retries']} retries")
+            for phase, stats in report["phases"].items():
+                print(f"{phase:>10}: {stats['wall_time']:6.2f}s {stats['requests']:6} requests {stats['bytes'] / 1024 / 1024:8.1f} MB")
+    finally:
+        if mdl.DOWNLOAD_ENGINE:
+            mdl.DOWNLOAD_ENGINE.close()
+        shutil.rmtree(scratch, ignore_errors=True)
+    print(f"mock: {mock.stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+'''
+Measures how replay server throughput scales with --workers on mixed tile and graph traffic.
+For each worker count the server is started on a copy of an archive with synthetic tiles, and load generator processes
+(so the client is not held to one core) send random tile GETs and graph POSTs over kept-alive connections for a fixed
+time.  With --reload the server is sent SIGHUP halfway through every run; requests retried on a new connection
+and ones that failed even then are counted.
+Usage: bench_workers.py [--workers 1,2,4] [--clients 4] [--connections 16] [--seconds 10] [--graph-ratio 0.2] [--reload] [archive_dir]
+'''
+
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_download import ROOT, loadDownloader  # noqa: E402
+from bench_serve import GRAPH_OPERATIONS, buildArchive, freePort  # noqa: E402
+
+
+def serve(archive, port, workers):
+    mdl = loadDownloader()
+    mdl.logging.getLogger().setLevel(mdl.logging.WARNING)
+    mdl.OurSimpleHTTPRequestHandler.log_message = lambda self, *args: None
+    sys.stdout = open(os.devnull, "w")
+    mdl.serveArchive(archive, "127.0.0.1", port, workers)
+
+
+def load(port, tiles, graph_ratio, connections, deadline, results):
+    '''
+    One load generator process, connections threads each on its own kept-alive connection until deadline.
+    '''
+    counts = {"tiles": 0, "graphs": 0, "retries": 0, "errors": 0, "bytes": 0}
+    lock = threading.Lock()
+
+    def run(seed):
+        rng = random.Random(seed)
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        done = {"tiles": 0, "graphs": 0, "retries": 0, "errors": 0, "bytes": 0}
+        while time.time() < deadline:
+            graph = rng.random() < graph_ratio
+            tile = rng.choice(tiles)
+            for attempt in range(2):
+                try:
+                    if graph:
+                        conn.request("POST", "/api/mp/models/graph", body=json.dumps({"operationName": rng.choice(GRAPH_OPERATIONS)}),
+                                     headers={"Content-Type": "application/json"})
+                    else:
+                        conn.request("GET", tile)
+                    response = conn.getresponse()
+                    done["bytes"] += len(response.read())
+                    done["graphs" if graph else "tiles"] += 1
+                    break
+                except (ConnectionError, http.client.HTTPException, socket.timeout):
+                    # a worker retiring on reload closes its kept-alive connections, browsers retry those once on a new one
+                    conn.close()
+                    done["retries" if attempt == 0 else "errors"] += 1
+        conn.close()
+        with lock:
+            for key, value in done.items():
+                counts[key] += value
+
+    threads = [threading.Thread(target=run, args=(seed,)) for seed in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put(counts)
+
+
+def waitForPort(port, timeout=30):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server did not come up on port {port}")
+
+
+def runWorkers(archive, tiles, workers, args):
+    port = freePort()
+    server = multiprocessing.Process(target=serve, args=(archive, port, workers))
+    server.start()
+    try:
+        waitForPort(port)
+        time.sleep(0.5)  # every worker bound, not just the first
+        results = multiprocessing.Queue()
+        start = time.time()
+        deadline = start + args.seconds
+        clients = [multiprocessing.Process(target=load, args=(port, tiles, args.graph_ratio, args.connections, deadline, results))
+                   for _ in range(args.clients)]
+        for client in clients:
+            client.start()
+        if args.reload:
+            time.sleep(args.seconds / 2)
+            os.kill(server.pid, signal.SIGHUP)
+        counts = {"tiles": 0, "graphs": 0, "retries": 0, "errors": 0, "bytes": 0}
+        for _ in clients:
+            for key, value in results.get().items():
+                counts[key] += value
+        for client in clients:
+            client.join()
+        elapsed = time.time() - start
+    finally:
+        server.terminate()
+        server.join()
+    return (counts["tiles"] + counts["graphs"]) / elapsed, counts, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("archive", nargs="?", default=os.path.join(ROOT, "downloads", "AxN4GbV5ko7"))
+    parser.add_argument("--workers", default="1,2,4", help="comma separated worker counts to run")
+    parser.add_argument("--clients", type=int, default=4, help="load generator processes")
+    parser.add_argument("--connections", type=int, default=16, help="kept-alive connections per load generator")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--graph-ratio", type=float, default=0.2, help="share of requests that are graph POSTs")
+    parser.add_argument("--sweeps", type=int, default=4)
+    parser.add_argument("--tile-bytes", type=int, default=48 * 1024)
+    parser.add_argument("--reload", action="store_true", help="send SIGHUP halfway through every run")
+    args = parser.parse_args()
+
+    mdl = loadDownloader()
+    scratch = tempfile.mkdtemp(prefix="bench_workers_")
+    try:
+        archive, sweeps = buildArchive(mdl, args.archive, scratch, args.sweeps, "2k", args.tile_bytes)
+        tiles = [path for sweep in sweeps for path in sweep]
+        print(f"{os.cpu_count()} cpus, {args.clients} load generators x {args.connections} connections, "
+              f"{args.graph_ratio:.0%} graph POSTs, {len(tiles)} tiles of {args.tile_bytes // 1024}KB, {args.seconds:.0f}s per run")
+        base = None
+        for workers in (int(count) for count in args.workers.split(",")):
+            rate, counts, elapsed = runWorkers(archive, tiles, workers, args)
+            base = base or rate
+            print(f"{workers:>3} workers: {rate:8.0f} req/s ({rate / base:4.2f}x), {counts['tiles']} tiles, {counts['graphs']} graphs, "
+                  f"{counts['bytes'] / 1024 / 1024 / elapsed:7.1f} MB/s, {counts['retries']} retried, {counts['errors']} failed")
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+'''
+Local stand-in for my.matterport.com, static.matterport.com and cdn-*.matterport.com, serving a recorded tour
+(an archive such as downloads/AxN4GbV5ko7) at the same url shapes, with synthetic tiles and textures.
+Point the downloader at it with URL_REWRITES = MockMatterport(...).rewrites(), requests then arrive as /<host>/<path>.
+Latency, bandwidth, the share of missing files, token lifetime and 429 throttling are configurable.
+Only the standard library is used, so it runs wherever the downloader's requirements.txt is installed.
+Usage: mock_cdn.py [archive_dir] [port], serves until interrupted.
+'''
+
+import glob
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN_IN_TEXT = re.compile(r't=2-[0-9a-f]+-\d+-\d')
+TILE_DEPTHS = ["512", "1k", "2k", "4k"]
+SHOWCASE_VERSION = "mock-1.0.0"
+# files?type=3 templates hold a literal {{filename}} placeholder, as the recorded files_type3 of a real tour does
+FILENAME_PLACEHOLDER = "{{filename}}"
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 4096  # a download opens hundreds of connections at once
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # kept-alive connections, as the real hosts keep them
+    mock = None  # the MockMatterport serving, set on a subclass per server
+
+    def do_GET(self):
+        self.mock.handle(self)
+
+    def do_POST(self):
+        self.mock.handle(self)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockMatterport:
+    '''
+    Serves one recorded tour. Everything under my.matterport.com and static.matterport.com comes from the archive,
+    the show page is rebuilt to look like the real one, and cdn model files are the archived .dam plus generated bytes.
+    '''
+
+    def __init__(self, archive, latency_ms=20, bandwidth=0, missing_ratio=0.0, token_ttl=3600, throttle_ratio=0.0,
+                 sweeps=None, tile_bytes=48 * 1024, texture_bytes=256 * 1024, tile_depth="2k", graph_batching=False, seed=1):
+        self.archive = os.path.abspath(archive)
+        self.pageid = os.path.basename(self.archive.rstrip("/"))
+        self.latency = latency_ms / 1000
+        self.bandwidth = bandwidth  # bytes per second per response, 0 for unlimited
+        self.missing_ratio = missing_ratio
+        self.token_ttl = token_ttl
+        self.throttle_ratio = throttle_ratio
+        self.tile_bytes = tile_bytes
+        self.texture_bytes = texture_bytes
+        self.tile_depth = TILE_DEPTHS.index(tile_depth)
+        self.graph_batching = graph_batching
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()  # every connection has its own thread
+        self.stats = {"requests": 0, "bytes": 0, "throttled": 0, "expired": 0, "missing": 0}
+
+        with open(self.path(f"api/v1/player/models/{self.pageid}/index.html"), "r", encoding="UTF-8") as f:
+            self.modeldata = json.load(f)
+        if sweeps:
+            self.modeldata["sweeps"] = {self.uuid(f"sweep{i}", dashes=True): {"vrenabled": False, "enabled": True} for i in range(sweeps)}
+        self.mesh_uuid = self.modeldata["job"]["uuid"]
+        self.accessid = os.path.basename(glob.glob(self.path("models/*"))[0])
+        self.dam = glob.glob(self.path(f"models/{self.accessid}/**/{self.mesh_uuid}_50k.dam"), recursive=True)[0]
+        self.runtime = os.path.basename(glob.glob(self.path("js/runtime~showcase.*.js"))[0])
+        self.showcase = os.path.basename(glob.glob(self.path("js/showcase.*.js"))[0])
+        self.three = os.path.basename(glob.glob(self.path("webgl-vendors/three/*"))[0])
+        self.issueToken()
+
+    def path(self, *parts):
+        return os.path.join(self.archive, *parts)
+
+    def uuid(self, name, dashes=False):
+        digest = hashlib.md5(f"{self.pageid}/{name}".encode()).hexdigest()
+        if dashes:
+            return f"{digest[:8]}-{digest[8:12]}-{digest[12:16]}-{digest[16:20]}-{digest[20:]}"
+        return digest
+
+    def issueToken(self):
+        with self.lock:
+            self.expires = int(time.time() + self.token_ttl)
+            self.token = f"2-{os.urandom(20).hex()}-{self.expires}-0"
+            return self.token
+
+    def count(self, stat, amount=1):
+        with self.lock:
+            self.stats[stat] += amount
+
+    def freshText(self, text):
+        return TOKEN_IN_TEXT.sub(f"t={self.token}", text)
+
+    def missing(self, key):
+        # Decided by the path so retries and reruns agree, the files the show page itself names always exist
+        if os.path.basename(key) in (self.runtime, self.showcase, f"{self.mesh_uuid}_50k.dam"):
+            return False
+        return int(hashlib.md5(key.encode()).hexdigest()[:8], 16) / 0xffffffff < self.missing_ratio
+
+    def rewrites(self):
+        return {"my.matterport.com": self.base, "static.matterport.com": self.base, "cdn-*.matterport.com": self.base}
+
+    def start(self, port=0):
+        handler = type("Handler", (MockHandler,), {"mock": self})
+        self.server = MockServer(("127.0.0.1", port), handler)
+        self.port = self.server.server_address[1]
+        self.base = f"http://127.0.0.1:{self.port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def handle(self, handler):
+        # Requests arrive as /<host>/<path>?<query>
+        self.count("requests")
+        url = urlsplit(handler.path)
+        host, _, path = url.path[1:].partition("/")
+        query = dict(parse_qsl(url.query))
+        body = handler.rfile.read(int(handler.headers.get("Content-Length") or 0)) if handler.command == "POST" else None
+        time.sleep(self.latency)
+        with self.lock:
+            throttled = self.throttle_ratio and self.random.random() < self.throttle_ratio
+        if throttled:
+            self.count("throttled")
+            return self.send(handler, 429, b"", {"Retry-After": "1"})
+        if host == "my.matterport.com":
+            answer = self.api(handler.command, path, query, body)
+        elif host == "static.matterport.com":
+            answer = self.static(path)
+        elif host.startswith("cdn-"):
+            answer = self.cdn(query, path)
+        else:
+            answer = 404
+        if isinstance(answer, int):
+            if answer == 404:
+                self.count("missing")
+            return self.send(handler, answer, b"")
+        self.count("bytes", len(answer))
+        self.send(handler, 200, answer)
+
+    def send(self, handler, status, body, headers=None):
+        handler.send_response(status)
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        if not self.bandwidth:
+            handler.wfile.write(body)
+            return
+        chunk = 16 * 1024
+        for start in range(0, len(body), chunk):
+            handler.wfile.write(body[start:start + chunk])
+            time.sleep(min(chunk, len(body) - start) / self.bandwidth)
+
+    def archived(self, relative):
+        file = self.path(relative)
+        if os.path.isfile(file) and os.path.commonpath([file, self.archive]) == self.archive:
+            with open(file, "rb") as f:
+                return f.read()
+        return 404
+
+    def api(self, method, path, query, body):
+        if method == "POST" and path == "api/mp/models/graph":
+            return self.graph(json.loads(body))
+        if path == "show/":
+            return self.showPage().encode("UTF-8")
+        if path == "favicon.ico":
+            return self.archived("favicon.ico")
+        if path == f"api/v1/player/models/{self.pageid}/":
+            return self.freshText(json.dumps(self.modeldata)).encode("UTF-8")
+        if path == f"api/player/models/{self.pageid}/files":
+            kind = query.get("type")
+            if kind == "3":
+                self.issueToken()
+                return json.dumps({"templates": [self.accessUrl(f"assets/~/{FILENAME_PLACEHOLDER}")], "catalog_file": "catalog.json",
+                                   "additional_files": [], "expires": self.expires, "type": "3"}).encode("UTF-8")
+            if kind in ("1", "2"):
+                body = self.archived(f"{path}_type{kind}")
+                return body if isinstance(body, int) else self.freshText(body.decode("UTF-8")).encode("UTF-8")
+        if path.endswith("/thumb"):
+            return self.archived(path)
+        return self.archived(path)
+
+    def graph(self, operations):
+        def answer(operation):
+            body = self.archived(f"api/mp/models/graph_{operation.get('operationName')}.json")
+            return json.loads(body) if not isinstance(body, int) else {"errors": [{"message": "unknown operation"}]}
+        if isinstance(operations, list):
+            if not self.graph_batching:
+                return 400
+            return json.dumps([answer(operation) for operation in operations]).encode("UTF-8")
+        return json.dumps(answer(operations)).encode("UTF-8")
+
+    def static(self, path):
+        if self.missing(path):
+            return 404
+        prefix = f"showcase/{SHOWCASE_VERSION}/"
+        if path.startswith(prefix):
+            return self.archived(path[len(prefix):])
+        if path.startswith("webgl-vendors/"):
+            return self.archived(path)
+        return 404
+
+    def accessUrl(self, filename):
+        return f"https://cdn-2.matterport.com/models/{self.accessid}/{filename}?t={self.token}&k=models%2F{self.accessid}"
+
+    def cdn(self, query, path):
+        token = query.get("t", "")
+        try:
+            expires = int(token.split("-")[2])
+        except (IndexError, ValueError):
+            return 403
+        if expires < time.time():
+            self.count("expired")
+            return 403
+        if self.missing(path):
+            return 404
+        name = os.path.basename(path)
+        if name == f"{self.mesh_uuid}_50k.dam":
+            with open(self.dam, "rb") as f:
+                return f.read()
+        match = re.search(r'/tiles/[0-9a-f]+/(\w+)_face\d_\d+_\d+\.jpg$', path)
+        if match:
+            if match.group(1) not in TILE_DEPTHS or TILE_DEPTHS.index(match.group(1)) > self.tile_depth:
+                return 404
+            return self.synthetic(path, self.tile_bytes)
+        if re.search(r'_50k_texture_jpg_(high|low)/', path):
+            return self.synthetic(path, self.texture_bytes if "crop" not in query else self.texture_bytes // 16)
+        if path.startswith("apifs/"):
+            return self.synthetic(path, self.texture_bytes)
+        return 404
+
+    def synthetic(self, path, size):
+        # Deterministic bytes so reruns and the blob store see identical files
+        seed = hashlib.sha256(path.encode()).digest()
+        return (seed * (size // len(seed) + 1))[:size]
+
+    def showPage(self):
+        self.issueToken()
+        prefetch = {"queries": {"GetModelPrefetch": {"data": {"model": {"assets": {
+            "tilesets": [{"urlTemplate": self.accessUrl("assets/~/tiles/<sweep>/<tile>")}],
+            "meshes": [{"url": self.accessUrl(f"assets/mesh_tiles/~/{self.mesh_uuid}_50k.dam")}],
+        }}}}}}
+        prefetch_js = json.dumps(prefetch).replace('\\', '\\\\').replace('"', '\\"')
+        static = f"https://static.matterport.com/showcase/{SHOWCASE_VERSION}/"
+        return f'''<!DOCTYPE html>
+<html>
+<head>
+<base href="{static}">
+<link rel="stylesheet" href="css/showcase.css">
+<script type="module" src="https://static.matterport.com/webgl-vendors/three/{self.three}/three.module.min.js"></script>
+</head>
+<body>
+<script>window.MP_PREFETCHED_MODELDATA = parseJSON("{prefetch_js}");</script>
+<script src="js/{self.runtime}"></script>
+<script src="js/{self.showcase}"></script>
+</body>
+</html>
+'''
+
+
+if __name__ == "__main__":
+    archive = sys.argv[1] if len(sys.argv) > 1 else os.path.join(ROOT, "downloads", "AxN4GbV5ko7")
+    mock = MockMatterport(archive).start(int(sys.argv[2]) if len(sys.argv) > 2 else 0)
+    print(f"Serving {mock.pageid} on {mock.base}/<host>/<path>")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
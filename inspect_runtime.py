@@ -1,35 +1,25 @@
 import glob
+import importlib.util
 import os
+import sys
 
-# Find the runtime file
-files = glob.glob("AxN4GbV5ko7/js/runtime~showcase*.js")
+# Shows what parseRuntime makes of a runtime~showcase.js, for when a new showcase version downloads too few chunks
+# Usage: inspect_runtime.py [runtime.js | archive_dir]
+spec = importlib.util.spec_from_file_location("matterport_dl", os.path.join(os.path.dirname(os.path.abspath(__file__)), "matterport-dl.py"))
+mdl = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(mdl)
+
+target = sys.argv[1] if len(sys.argv) > 1 else "downloads/AxN4GbV5ko7"
+files = [target] if os.path.isfile(target) else glob.glob(os.path.join(target, "js", "runtime~showcase*.js"))
 if not files:
-    files = glob.glob("downloads/AxN4GbV5ko7/js/runtime~showcase*.js")
-if files:
-    print(f"Found file: {files[0]}")
-    with open(files[0], 'r') as f:
-        content = f.read()
-        
-        # Find the part with chunk mapping
-        # Look for n.u=
-        idx = content.find('n.u=')
-        if idx != -1:
-            print("Found n.u= at index", idx)
-            print("Context around n.u=:")
-            print(content[idx:idx+1000])
-        else:
-            print("Could not find n.u=")
-            
-        # Look for the hash mapping part: +{...}[e]+".js"
-        # It usually follows the name mapping
-        # Try to find the second dictionary
-        # Look for "+"."+
-        idx2 = content.find('"+"."+')
-        if idx2 != -1:
-            print("Found \"+\".\"+ at index", idx2)
-            print("Context around \"+\".\"+:")
-            print(content[idx2:idx2+1000])
-        else:
-             print("Could not find \"+\".\"+")
-else:
-    print("No runtime file found")
+    sys.exit("No runtime file found")
+with open(files[0], "r", encoding="UTF-8") as f:
+    content = f.read()
+print(f"Found file: {files[0]}")
+
+for site in mdl.RUNTIME_SITE.finditer(content):
+    print(f"{site.group(1)} assigned at index {site.start()}: {content[site.start():site.start() + 200]}")
+js_chunks, css_chunks = mdl.parseRuntime(content)
+named = [f"{chunk_id}={name}" for chunk_id, name, _ in js_chunks if name != chunk_id]
+print(f"{len(js_chunks)} js chunks, {len(named)} named: {', '.join(named)}")
+print(f"{len(css_chunks)} css chunks: {', '.join(css_chunks)}")
@@ -10,22 +10,49 @@ import requests
 import json
 import threading
 import concurrent.futures
+import asyncio
+import functools
+import fnmatch
+import collections
+import heapq
+import random
+import itertools
+import contextvars
 import urllib.request
+import urllib.parse
 from urllib.parse import urlparse
 import pathlib
 import re
 import os
 import shutil
+import signal
+import socket
 import sys
+import sqlite3
+import hashlib
+import tempfile
 import time
 import logging
+import multiprocessing
 from tqdm import tqdm
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from http import HTTPStatus
+import mimetypes
+import gzip
+import email.utils
+import datetime
 import decimal
+import glob
 
 
-# Weird hack
-accessurls = []
 SHOWCASE_INTERNAL_NAME = "showcase.js" # Will be updated dynamically
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
@@ -34,11 +61,296 @@ def makeDirs(dirname):
     pathlib.Path(dirname).mkdir(parents=True, exist_ok=True)
 
 
-def getVariants():
+CURRENT_JOB = contextvars.ContextVar("CURRENT_JOB", default=None)
+
+
+class TourJob:
+    '''
+    State for downloading one tour: its archive root, access token, graph queries and manifest.
+    Kept per job rather than in globals so a batch can download several tours at once in one process.
+    '''
+
+    def __init__(self, pageid, root):
+        self.pageid = pageid
+        self.root = os.path.abspath(root)
+        self.tokens = TokenManager(pageid)
+        self.graph_data_req = {}
+        self.manifest = None
+        self.release = ""  # runtime~showcase hash of the showcase build this tour is served with
+        self.revalidate = []  # archive paths that --update fetches again even though they exist, ie changed sweeps
+        self.plan = None  # DownloadPlan when this is a --plan run
+        self.metrics = RunMetrics()
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def mutable(self, url, file):
+        # Whether file can change upstream without its url changing
+        if urlparse(url).hostname in MUTABLE_HOSTS:
+            return True
+        return any(file.startswith(self.path(prefix)) for prefix in self.revalidate)
+
+
+MUTABLE_HOSTS = ["my.matterport.com"]
+
+
+TOKEN_PATTERN = re.compile(r't=(.*?)&')
+KEY_PATTERN = re.compile(r'k=(.*?)"')
+TOKEN_REPLACE = re.compile(r't=.*?&')
+KEY_REPLACE = re.compile(r'k=.*?$')
+TOKEN_REFRESH_MARGIN = 300  # seconds before expiry to fetch a new token
+TOKEN_REFRESH_INTERVAL = 30  # minimum seconds between refreshes caused by 401/403 responses
+
+
+class TokenManager:
+    '''
+    Owns a tour's t=/k= cdn access token. Tokens look like 2-<signature>-<expires>-0, so the expiry is known up front
+    and the token is refreshed from files?type=3 shortly before it runs out or on the first 401/403.
+    Also remembers which access url (the main token or one of the alternates from files?type=2/3) is currently working
+    so later requests go straight to it rather than walking the whole list for every file.
+    '''
+
+    def __init__(self, pageid):
+        self.pageid = pageid
+        self.token = None
+        self.key = None
+        self.expires = None
+        self.alternates = []  # query strings of other access urls
+        self.preferred = None  # None while the main token works, otherwise the alternate that last did
+        self.refresh_lock = None
+        self.refreshed_at = 0
+        self.refreshes = 0
+
+    def update(self, text):
+        match = TOKEN_PATTERN.search(text)
+        if match:
+            self.token = match.group(1)
+            try:
+                self.expires = int(self.token.split("-")[2])
+            except (IndexError, ValueError):
+                self.expires = None
+        match = KEY_PATTERN.search(text)
+        if match:
+            self.key = match.group(1)
+
+    def apply(self, url):
+        if self.token and self.key and "t=" in url:
+            url = TOKEN_REPLACE.sub(f't={self.token}&', url, count=1)
+            url = KEY_REPLACE.sub(f'k={self.key}', url, count=1)
+        return url
+
+    def routes(self, url):
+        '''
+        Urls to try for url in order, the route that worked last time first.
+        '''
+        if "?t=" not in url:
+            return [url]
+        base = url.split('?')[0]
+        routes = [self.apply(url)] + [f"{base}?{alternate}" for alternate in self.alternates]
+        if self.preferred in self.alternates:
+            routes.insert(0, routes.pop(self.alternates.index(self.preferred) + 1))
+        return routes
+
+    def learn(self, route):
+        query = route.split('?', 1)[-1]
+        preferred = query if query in self.alternates else None
+        if preferred != self.preferred:
+            logging.info(f'Switching downloads to {"alternate access url " + query if preferred else "the main access token"}')
+            self.preferred = preferred
+
+    def expiring(self):
+        return self.expires is not None and time.time() > self.expires - TOKEN_REFRESH_MARGIN
+
+    async def refresh(self, failed_url=None):
+        '''
+        Fetches a fresh token, only once however many requests ask at the same time.
+        Returns True if the token changed since failed_url was issued, ie retrying it is worthwhile.
+        '''
+        if self.refresh_lock is None:
+            self.refresh_lock = asyncio.Lock()
+        async with self.refresh_lock:
+            if failed_url is not None and self.token and f't={self.token}&' not in failed_url:
+                return True  # someone else already refreshed while this request was in flight
+            if failed_url is None and (not self.expiring() or time.time() - self.refreshed_at < TOKEN_REFRESH_INTERVAL):
+                return False  # still valid, or tokens are issued with less than TOKEN_REFRESH_MARGIN left anyway
+            if failed_url is not None and not self.expiring() and time.time() - self.refreshed_at < TOKEN_REFRESH_INTERVAL:
+                return False  # just refreshed, this 403 is not about the token
+            status, body = await getEngine().get(f"https://my.matterport.com/api/player/models/{self.pageid}/files?type=3")
+            if status >= 400:
+                logging.warning(f'Could not refresh the access token: HTTP {status}')
+                return False
+            old_token = self.token
+            self.update(body.decode("UTF-8"))
+            self.refreshed_at = time.time()
+            self.refreshes += 1
+            logging.info(f'Refreshed the access token, now valid until {time.ctime(self.expires) if self.expires else "unknown"}')
+            return self.token != old_token
+
+
+def currentJob():
+    # Set by downloadPage, asyncio tasks started from it inherit it so the engine loop sees the right job too
+    return CURRENT_JOB.get()
+
+
+def jobPath(file):
+    # Relative paths are relative to the archive root of the tour being downloaded
+    job = currentJob()
+    if job is None or os.path.isabs(file):
+        return file
+    return job.path(file)
+
+
+class JobLogFilter(logging.Filter):
+    def __init__(self, job):
+        super().__init__()
+        self.job = job
+
+    def filter(self, record):
+        return currentJob() is self.job
+
+
+def percentile(values, fraction):
+    # values must be sorted
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class RunMetrics:
+    '''
+    Counters for one tour's run, fed by DownloadEngine.request: wall time, requests, bytes and status codes per phase,
+    and requests, bytes, status codes, retries and latencies per host. Written to run_report.json by writeRunReport.
+    '''
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = {}
+        self.phase = None
+        self.phase_started = None
+        self.hosts = {}
+
+    def begin(self, phase):
+        # Phases run one after another, starting one ends the previous
+        self.end()
+        self.phase = phase
+        self.phase_started = time.monotonic()
+        self.phases.setdefault(phase, {"wall_time": 0.0, "requests": 0, "bytes": 0, "statuses": {}})
+
+    def end(self):
+        if self.phase:
+            self.phases[self.phase]["wall_time"] += time.monotonic() - self.phase_started
+            self.phase = None
+
+    def record(self, host, status, size, latency):
+        status = str(status) if status is not None else "error"
+        stats = self.hosts.setdefault(host, {"requests": 0, "bytes": 0, "statuses": {}, "retries": 0, "latencies": []})
+        stats["requests"] += 1
+        stats["bytes"] += size
+        stats["statuses"][status] = stats["statuses"].get(status, 0) + 1
+        stats["latencies"].append(latency)
+        if self.phase:
+            phase = self.phases[self.phase]
+            phase["requests"] += 1
+            phase["bytes"] += size
+            phase["statuses"][status] = phase["statuses"].get(status, 0) + 1
+
+    def retried(self, host):
+        self.hosts.setdefault(host, {"requests": 0, "bytes": 0, "statuses": {}, "retries": 0, "latencies": []})["retries"] += 1
+
+    def report(self):
+        hosts = {}
+        for host, stats in self.hosts.items():
+            latencies = sorted(stats["latencies"])
+            hosts[host] = {key: value for key, value in stats.items() if key != "latencies"}
+            hosts[host]["latency"] = {name: percentile(latencies, fraction) for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1))}
+            hosts[host]["latency"].update(sum=sum(latencies), count=len(latencies))
+        return {
+            "started": self.started,
+            "wall_time": time.time() - self.started,
+            "requests": sum(stats["requests"] for stats in self.hosts.values()),
+            "bytes": sum(stats["bytes"] for stats in self.hosts.values()),
+            "retries": sum(stats["retries"] for stats in self.hosts.values()),
+            "phases": self.phases,
+            "hosts": hosts,
+        }
+
+
+def beginPhase(phase):
+    job = currentJob()
+    if job:
+        job.metrics.begin(phase)
+
+
+RUN_REPORT_FILE = "run_report.json"
+METRICS_TEXTFILE = None  # --metrics-textfile, Prometheus node_exporter textfile collector output
+METRICS_TEXTFILE_LOCK = threading.Lock()
+METRICS_TEXTFILE_JOBS = {}  # pageid -> lines, so a batch run keeps every tour in the file
+
+
+def writeRunReport(job, error=None):
+    job.metrics.end()
+    report = {"pageid": job.pageid, "release": job.release, "result": "failed" if error else "ok", **job.metrics.report()}
+    if error:
+        report["error"] = str(error)
+    with open(job.path(RUN_REPORT_FILE), "w", encoding="UTF-8") as f:
+        json.dump(report, f, indent=2)
+    if METRICS_TEXTFILE:
+        writeMetricsTextfile(report)
+
+
+# metric: (type, help), written in this order; counters hold the run's totals and start over with the next run
+METRICS_TEXTFILE_FAMILIES = {
+    "run_seconds": ("gauge", "Wall time of the last run"),
+    "run_success": ("gauge", "Whether the last run finished"),
+    "phase_seconds": ("gauge", "Wall time per phase"),
+    "phase_bytes": ("gauge", "Bytes downloaded per phase"),
+    "bytes_total": ("counter", "Bytes downloaded per host"),
+    "retries_total": ("counter", "Retried requests per host"),
+    "requests_total": ("counter", "Requests per host and status code"),
+    "request_seconds": ("summary", "Request latency per host"),
+}
+
+
+def writeMetricsTextfile(report):
+    labels = f'pageid="{report["pageid"]}",release="{report["release"]}"'
+    # (metric family, sample line), a summary's _sum and _count samples belong to its family
+    lines = [("run_seconds", f'matterport_dl_run_seconds{{{labels}}} {report["wall_time"]:.3f}'),
+             ("run_success", f'matterport_dl_run_success{{{labels}}} {0 if report.get("error") else 1}')]
+    for phase, stats in report["phases"].items():
+        lines.append(("phase_seconds", f'matterport_dl_phase_seconds{{{labels},phase="{phase}"}} {stats["wall_time"]:.3f}'))
+        lines.append(("phase_bytes", f'matterport_dl_phase_bytes{{{labels},phase="{phase}"}} {stats["bytes"]}'))
+    for host, stats in report["hosts"].items():
+        host_labels = f'{labels},host="{host}"'
+        lines.append(("bytes_total", f'matterport_dl_bytes_total{{{host_labels}}} {stats["bytes"]}'))
+        lines.append(("retries_total", f'matterport_dl_retries_total{{{host_labels}}} {stats["retries"]}'))
+        for status, count in stats["statuses"].items():
+            lines.append(("requests_total", f'matterport_dl_requests_total{{{host_labels},status="{status}"}} {count}'))
+        latency = stats["latency"]
+        for name in ("p50", "p90", "p99"):
+            if latency[name] is not None:
+                lines.append(("request_seconds", f'matterport_dl_request_seconds{{{host_labels},quantile="0.{name[1:]}"}} {latency[name]:.4f}'))
+        lines.append(("request_seconds", f'matterport_dl_request_seconds_sum{{{host_labels}}} {latency["sum"]:.4f}'))
+        lines.append(("request_seconds", f'matterport_dl_request_seconds_count{{{host_labels}}} {latency["count"]}'))
+    with METRICS_TEXTFILE_LOCK:
+        METRICS_TEXTFILE_JOBS[report["pageid"]] = lines
+        # Written under a temporary name and renamed so the collector never reads half a file
+        tmp = f"{METRICS_TEXTFILE}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="UTF-8") as f:
+            for metric, (kind, description) in METRICS_TEXTFILE_FAMILIES.items():
+                f.write(f"# HELP matterport_dl_{metric} {description}\n# TYPE matterport_dl_{metric} {kind}\n")
+                for job_lines in METRICS_TEXTFILE_JOBS.values():
+                    f.writelines(line + "\n" for family, line in job_lines if family == metric)
+        os.replace(tmp, METRICS_TEXTFILE)
+
+
+TILE_DEPTHS = ["512", "1k", "2k", "4k"]
+TILE_DEPTH_FILE = "tile_depth.json"  # written next to tiles/ so reruns skip the probe
+
+
+def getVariants(max_depth=len(TILE_DEPTHS) - 1):
     variants = []
-    depths = ["512", "1k", "2k", "4k"]
-    for depth in range(4):
-        z = depths[depth]
+    for depth in range(max_depth + 1):
+        z = TILE_DEPTHS[depth]
         for x in range(2**depth):
             for y in range(2**depth):
                 for face in range(6):
@@ -46,219 +358,1507 @@ def getVariants():
     return variants
 
 
-def downloadUUID(accessurl, uuid):
-    downloadFile(accessurl.format(
-        filename=f'{uuid}_50k.dam'), f'{uuid}_50k.dam')
-    shutil.copy(f'{uuid}_50k.dam', f'..{os.path.sep}{uuid}_50k.dam')
+DAM_TEXTURE_NAME = re.compile(rb'[\w\-]+\.jpg')
+
+
+def readVarint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def parseDamMessage(data, pos, end, textures):
+    # .dam files are protobuf messages, walk the wire format and collect every string field naming a .jpg
+    while pos < end:
+        key, pos = readVarint(data, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            _, pos = readVarint(data, pos)
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 5:
+            pos += 4
+        elif wire_type == 2:
+            length, pos = readVarint(data, pos)
+            if pos + length > end:
+                raise ValueError("field runs past the end of its message")
+            if length < 256 and DAM_TEXTURE_NAME.fullmatch(data, pos, pos + length):
+                textures.add(data[pos:pos + length].decode("ascii"))
+            else:
+                # Could be a nested message or just packed vertex data, only keep what parses cleanly
+                nested = set()
+                try:
+                    parseDamMessage(data, pos, pos + length, nested)
+                    textures.update(nested)
+                except (ValueError, IndexError):
+                    pass
+            pos += length
+        else:
+            raise ValueError(f"unexpected wire type {wire_type}")
+    if pos != end:
+        raise ValueError("message does not end on a field boundary")
+
+
+def parseDamTextures(data):
+    '''
+    Returns the sorted texture file names referenced by a .dam mesh, ie [UUID_50k_000.jpg, ...]
+    Raises ValueError if the mesh can not be parsed or names no textures.
+    '''
+    textures = set()
+    try:
+        parseDamMessage(data, 0, len(data), textures)
+    except IndexError as ex:
+        raise ValueError(f"malformed .dam file: {ex}")
+    if not textures:
+        raise ValueError("no textures referenced in .dam file")
+    return sorted(textures)
+
+
+def textureJobs(accessurl, uuid, textures, model_dir):
+    for texture in textures:
+        for quality in ["high", "low"]:
+            file = f'{uuid}_50k_texture_jpg_{quality}/{texture}'
+            yield accessurl.format(filename=file), f'{model_dir}/{file}'
+
+
+def probeTextures(accessurl, uuid, model_dir):
     cur_file = ""
     try:
         for i in range(1000):
             cur_file = accessurl.format(
                 filename=f'{uuid}_50k_texture_jpg_high/{uuid}_50k_{i:03d}.jpg')
             downloadFile(
-                cur_file, f'{uuid}_50k_texture_jpg_high/{uuid}_50k_{i:03d}.jpg')
+                cur_file, f'{model_dir}/{uuid}_50k_texture_jpg_high/{uuid}_50k_{i:03d}.jpg')
             cur_file = accessurl.format(
                 filename=f'{uuid}_50k_texture_jpg_low/{uuid}_50k_{i:03d}.jpg')
             downloadFile(
-                cur_file, f'{uuid}_50k_texture_jpg_low/{uuid}_50k_{i:03d}.jpg')
+                cur_file, f'{model_dir}/{uuid}_50k_texture_jpg_low/{uuid}_50k_{i:03d}.jpg')
     except Exception as ex:
         logging.warning(
             f'Exception downloading file: {cur_file} of: {str(ex)}')
         pass  # very lazy and bad way to only download required files
 
 
-def downloadSweeps(accessurl, sweeps):
-    with tqdm(total=(len(sweeps)*len(getVariants()))) as pbar:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=32) as executor:
-            for sweep in sweeps:
-                sweep = sweep.replace("-", "")
-                for variant in getVariants():
-                    pbar.update(1)
-                    executor.submit(downloadFile, accessurl.format(
-                        filename=f'tiles/{sweep}/{variant}') + "&imageopt=1", f'tiles/{sweep}/{variant}')
-                    while executor._work_queue.qsize() > 64:
-                        time.sleep(0.01)
-
-
-def downloadFileWithJSONPost(url, file, post_json_str, descriptor):
-    global PROXY
-    if "/" in file:
-        makeDirs(os.path.dirname(file))
-    # skip already downloaded files except index.html which is really json possibly wit hnewer access keys?
-    if os.path.exists(file):
-        logging.debug(
-            f'Skipping json post to url: {url} ({descriptor}) as already downloaded')
+def downloadUUID(accessurl, uuid, model_dir):
+    '''
+    Downloads the .dam mesh into model_dir and returns the (url, file) jobs for the textures it references.
+    Falls back to probing texture indices one at a time if the mesh can not be parsed.
+    '''
+    dam_file = jobPath(f'{model_dir}/{uuid}_50k.dam')
+    downloadFile(accessurl.format(
+        filename=f'{uuid}_50k.dam'), dam_file)
+    linkFile(dam_file, os.path.join(os.path.dirname(os.path.dirname(dam_file)), f'{uuid}_50k.dam'))
+    try:
+        with open(dam_file, 'rb') as f:
+            textures = parseDamTextures(f.read())
+    except (OSError, ValueError) as ex:
+        logging.warning(f'Could not read the texture list from {uuid}_50k.dam ({str(ex)}), probing for textures instead')
+        probeTextures(accessurl, uuid, model_dir)
+        return []
+    logging.info(f'Found {len(textures)} textures in {uuid}_50k.dam')
+    return list(textureJobs(accessurl, uuid, textures, model_dir))
 
-    opener = getUrlOpener(PROXY)
-    opener.addheaders.append(('Content-Type', 'application/json'))
 
-    req = urllib.request.Request(url)
+def sweepJobs(accessurl, sweeps, variants, model_dir):
+    for sweep in sweeps:
+        sweep = sweep.replace("-", "")
+        for variant in variants:
+            yield accessurl.format(filename=f'tiles/{sweep}/{variant}') + "&imageopt=1", f'{model_dir}/tiles/{sweep}/{variant}'
 
-    for header in opener.addheaders:  # not sure why we can't use the opener itself but it doesn't override it properly
-        req.add_header(header[0], header[1])
 
-    body_bytes = bytes(post_json_str, "utf-8")
-    req.add_header('Content-Length', len(body_bytes))
-    resp = urllib.request.urlopen(req, body_bytes)
-    with open(file, 'w', encoding="UTF-8") as the_file:
-        the_file.write(resp.read().decode("UTF-8"))
-    logging.debug(
-        f'Successfully downloaded w/ JSON post to: {url} ({descriptor}) to: {file}')
+def getTileDepthHint(pageid):
+    # files?type=1 lists the panorama resolutions the model was processed at, ie assets/pan/4k/...
+    try:
+        with open(jobPath(f"api/player/models/{pageid}/files_type1"), "r", encoding="UTF-8") as f:
+            files = f.read()
+    except OSError:
+        return len(TILE_DEPTHS) - 1
+    for depth in reversed(range(len(TILE_DEPTHS))):
+        if f"pan/{TILE_DEPTHS[depth]}/" in files:
+            return depth
+    return len(TILE_DEPTHS) - 1
+
+
+def getTileDepth(accessurl, sweep, max_depth, model_dir):
+    '''
+    Finds the deepest tile level this model has by fetching face0_0_0 of the first sweep from max_depth downwards.
+    The result is saved to TILE_DEPTH_FILE in model_dir so later runs do not probe again.
+    '''
+    depth_file = jobPath(f'{model_dir}/{TILE_DEPTH_FILE}')
+    if os.path.exists(depth_file):
+        with open(depth_file, "r", encoding="UTF-8") as f:
+            return json.load(f)["depth"]
+    sweep = sweep.replace("-", "")
+    for depth in reversed(range(max_depth + 1)):
+        variant = f"{TILE_DEPTHS[depth]}_face0_0_0.jpg"
+        try:
+            downloadFile(accessurl.format(filename=f'tiles/{sweep}/{variant}') + "&imageopt=1", f'{model_dir}/tiles/{sweep}/{variant}')
+        except MissingFileError:
+            continue
+        except Exception as ex:
+            # Only a 404 says the level is absent, after any other failure the level may exist, so every variant up
+            # to it is requested and nothing is saved for later runs to trust
+            logging.warning(f'Could not probe tile depth {TILE_DEPTHS[depth]} ({ex}), requesting every variant up to it')
+            return depth
+        logging.info(f'Detected tile depth {TILE_DEPTHS[depth]} for this model')
+        with open(depth_file, "w", encoding="UTF-8") as f:
+            json.dump({"depth": depth, "name": TILE_DEPTHS[depth]}, f)
+        return depth
+    logging.warning(f'Could not detect tile depth, requesting every variant up to {TILE_DEPTHS[max_depth]}')
+    return max_depth
+
+
+def downloadSweeps(accessurl, sweeps, model_dir, max_depth=len(TILE_DEPTHS) - 1, texture_jobs=()):
+    # Textures share the pipeline with the tiles so they download in parallel with them
+    variants = getVariants(getTileDepth(accessurl, next(iter(sweeps)), max_depth, model_dir)) if sweeps else []
+    jobs = itertools.chain(texture_jobs, sweepJobs(accessurl, sweeps, variants, model_dir))
+    downloadFiles(jobs, desc="Sweeps", total=len(texture_jobs) + len(sweeps) * len(variants))
+
+
+# Crops of the high textures the dollhouse/floorplan views request, each one a grid over the texture at increment steps
+ADV_CROP_FETCH = [
+    {
+            "start": "width=512&crop=1024,1024,",
+            "increment": '0.5'
+        },
+    {
+            "start": "crop=512,512,",
+            "increment": '0.25'
+        }
+]
+TEXTURE_PIXELS = 2048 * 2048  # high textures are 2048x2048
+
+
+def cropQueries():
+    '''
+    Yields (query, file_suffix, relative_size) for every crop in ADV_CROP_FETCH. file_suffix is what the server's
+    do_GET looks for after the texture path, relative_size the crop's pixel count as a fraction of the full texture.
+    '''
+    for crop in ADV_CROP_FETCH:
+        w, h = (int(v) for v in re.search(r'crop=(\d+),(\d+),', crop["start"]).groups())
+        width = re.search(r'width=(\d+)', crop["start"])
+        pixels = int(width.group(1)) ** 2 * h / w if width else w * h
+        steps = list(drange(0, 1, decimal.Decimal(crop["increment"])))
+        for x in steps:
+            for y in steps:
+                xs = f'{x}'.removesuffix('.0')
+                ys = f'{y}'.removesuffix('.0')
+                query = f'{crop["start"]}x{xs},y{ys}'
+                yield query, query.replace("&", "_") + ".jpg", pixels / TEXTURE_PIXELS
+
+
+def cropJobs(accessurl, mesh_uuid, textures, model_dir):
+    # dict keeps the order while dropping repeated (url, file) pairs
+    jobs = {}
+    for texture in textures:
+        file = f'{mesh_uuid}_50k_texture_jpg_high/{texture}'
+        url = accessurl.format(filename=file)
+        for query, suffix, _ in cropQueries():
+            jobs[(f"{url}&{query}", f'{model_dir}/{file}{suffix}')] = None
+    return list(jobs)
+
+
+def downloadCrops(accessurl, mesh_uuid, model_dir, textures=None):
+    '''
+    --advanced-download: fetches the cropped high textures for textures, by default every texture of the mesh already in the archive.
+    '''
+    print("Doing advanced download of dollhouse/floorplan data...")
+    texture_dir = jobPath(f'{model_dir}/{mesh_uuid}_50k_texture_jpg_high')
+    if not textures:
+        try:
+            textures = sorted(name for name in os.listdir(texture_dir) if DAM_TEXTURE_NAME.fullmatch(name))
+        except OSError:
+            textures = []
+    if not textures:
+        logging.warning(f'No high textures in {texture_dir}, skipping the dollhouse/floorplan crops')
+        return
+    jobs = cropJobs(accessurl, mesh_uuid, textures, model_dir)
+    # A crop costs about its share of the texture's pixels, scaled from the textures' average size on disk
+    sizes = [os.path.getsize(os.path.join(texture_dir, name)) for name in textures if os.path.exists(os.path.join(texture_dir, name))]
+    if sizes:
+        estimate = sum(sizes) / len(sizes) * len(textures) * sum(relative for _, _, relative in cropQueries())
+        print(f"{len(jobs)} crops of {len(textures)} textures, about {estimate / 1024 / 1024:.0f} MB")
+    else:
+        print(f"{len(jobs)} crops of {len(textures)} textures")
+    downloadFiles(jobs, desc="Crops")
 
 
 # Create a session object
 session = requests.Session()
 
-def downloadFile(url, file, post_data=None):
-    global accessurls
-    url = GetOrReplaceKey(url, False)
+URL_REWRITES = {}  # host (fnmatch pattern) -> base url serving it instead, used by benchmarks/mock_cdn.py
+
+
+def rewriteUrl(url):
+    '''
+    Sends requests for a host in URL_REWRITES to <base>/<host>/<path> instead. Only applied where requests are sent,
+    so urls in pages, plans, manifests and logs keep their real hosts.
+    '''
+    if not URL_REWRITES:
+        return url
+    parsed = urlparse(url)
+    for pattern, base in URL_REWRITES.items():
+        if fnmatch.fnmatch(parsed.hostname or "", pattern):
+            return f"{base}/{parsed.hostname}{url[len(parsed.scheme) + 3 + len(parsed.netloc):]}"
+    return url
+
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.5790.110 Safari/537.36",
+    "Referer": "https://my.matterport.com/",
+}
+MAX_CONNECTIONS = 256  # requests in flight at once, override with --max-connections
+CHUNK_SIZE = 64 * 1024  # bytes buffered per response while streaming to disk, override with --chunk-size
+
+
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 0.5  # seconds, doubled on every retry and jittered by +-50%
+RETRY_MAX_DELAY = 30
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+BACKOFF_STATUSES = {429, 502, 503, 504}  # responses that mean we are pushing the host too hard
+INITIAL_HOST_WINDOW = 16  # concurrent requests per host before the window adapts
+RETRYABLE_ERRORS = (asyncio.TimeoutError, ConnectionError, requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+if aiohttp:
+    RETRYABLE_ERRORS += (aiohttp.ClientError,)
+
+
+def retryAfter(headers):
+    try:
+        return min(RETRY_MAX_DELAY, float(headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        return None
+
+
+class HostLimiter:
+    '''
+    AIMD concurrency window for one host, much like TCP congestion control. The window grows by about one request per
+    window's worth of healthy responses while latency stays near the best seen, and halves on 429/5xx or timeouts.
+    '''
+
+    def __init__(self, host, initial, maximum):
+        self.host = host
+        self.window = float(initial)
+        self.maximum = maximum
+        self.in_flight = 0
+        self.waiters = collections.deque()
+        self.latency = None  # moving average in seconds
+        self.best_latency = None
+        self.last_decrease = 0
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+
+    async def acquire(self):
+        while self.in_flight >= int(self.window):
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            await waiter
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self.wake()
+
+    def wake(self):
+        free = int(self.window) - self.in_flight
+        while free > 0 and self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def success(self, latency):
+        self.requests += 1
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        self.best_latency = latency if self.best_latency is None else min(self.best_latency, latency)
+        # Rising latency means requests are queueing at the host, hold the window there
+        if self.latency < self.best_latency * 2 + 0.05:
+            self.window = min(self.maximum, self.window + 1 / self.window)
+            self.wake()
+
+    def backoff(self):
+        self.errors += 1
+        now = time.monotonic()
+        # Halve at most once per round trip so a burst of throttled responses counts as one signal
+        if now - self.last_decrease > (self.latency or 1):
+            self.window = max(1.0, self.window / 2)
+            self.last_decrease = now
+            logging.debug(f'Backing off {self.host} to {int(self.window)} concurrent requests')
+
+
+class DownloadEngine:
+    '''
+    Runs every download on a single asyncio loop living in a background thread.
+    Uses aiohttp when it is installed, otherwise falls back to running the shared requests session on worker threads.
+    Requests to each host go through a HostLimiter and are retried with backoff when throttled.
+    '''
+
+    def __init__(self, max_connections=MAX_CONNECTIONS):
+        self.max_connections = max_connections
+        self.http = None
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="download-engine", daemon=True)
+        self.thread.start()
+        self.run(self._setup())
+
+    async def _setup(self):
+        self.semaphore = asyncio.Semaphore(self.max_connections)
+        self.limiters = {}
+        if aiohttp:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, ttl_dns_cache=300)
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+            self.http = aiohttp.ClientSession(connector=connector, timeout=timeout, headers=DEFAULT_HEADERS)
+            self.proxy = None
+            if PROXY:
+                self.proxy = PROXY if "://" in PROXY else f"http://{PROXY}"
+        else:
+            logging.info("aiohttp not installed, downloads will run on a thread pool instead")
+            workers = min(self.max_connections, 64)
+            adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self.loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=workers))
+
+    def run(self, coro):
+        # Blocks the calling thread until coro has finished on the engine loop
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def limiter(self, url):
+        host = urlparse(url).hostname or ""
+        if host not in self.limiters:
+            self.limiters[host] = HostLimiter(host, min(INITIAL_HOST_WINDOW, self.max_connections), self.max_connections)
+        return self.limiters[host]
+
+    def describeLimits(self):
+        # Short summary of every host's window and retry count for the progress bar
+        return " ".join(f"{limiter.host.split('.')[0]}:{int(limiter.window)}/r{limiter.retries}" for limiter in self.limiters.values())
+
+    async def request(self, url, attempt):
+        '''
+        Runs attempt(url), one HTTP exchange returning (status_code, result, retry_after), under url's host limiter.
+        Throttled, failed and timed out exchanges are retried up to MAX_RETRIES times with jittered exponential backoff.
+        '''
+        limiter = self.limiter(url)
+        job = currentJob()
+        for retry in range(MAX_RETRIES + 1):
+            status = None
+            result = None
+            retry_after = None
+            await limiter.acquire()
+            start = time.monotonic()
+            try:
+                async with self.semaphore:
+                    status, result, retry_after = await attempt(rewriteUrl(url))
+            except RETRYABLE_ERRORS as ex:
+                error = ex
+            finally:
+                limiter.release()
+                if job:
+                    size = result.size if isinstance(result, AtomicFile) else len(result) if isinstance(result, bytes) else 0
+                    job.metrics.record(limiter.host, status, size, time.monotonic() - start)
+            if status is not None and status not in RETRY_STATUSES:
+                limiter.success(time.monotonic() - start)
+                return status, result
+            if status is None or status in BACKOFF_STATUSES:
+                limiter.backoff()
+            if retry == MAX_RETRIES:
+                if status is None:
+                    raise error
+                return status, result
+            limiter.retries += 1
+            if job:
+                job.metrics.retried(limiter.host)
+            delay = retry_after or min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** retry) * random.uniform(0.5, 1.5)
+            logging.debug(f'Retrying {url} in {delay:.1f}s after {status or repr(error)}')
+            await asyncio.sleep(delay)
+
+    async def fetch(self, url, file, headers=None, shared=False):
+        '''
+        Streams url into file in CHUNK_SIZE pieces and returns (status_code, AtomicFile or None).
+        file is only created, complete and synced, when the response was successful. headers may carry
+        If-None-Match/If-Modified-Since, a 304 answer leaves file untouched. shared goes to the AtomicFile.
+        '''
+        async def attempt(url):
+            if not self.http:
+                return await self.loop.run_in_executor(None, fetchBlocking, url, file, headers, shared)
+            async with self.http.get(url, proxy=self.proxy, headers=headers) as response:
+                if response.status >= 400 or response.status == 304:
+                    return response.status, None, retryAfter(response.headers)
+                # creating, writing, hashing and syncing the file all block, they run on the executor so the loop
+                # keeps every other transfer moving meanwhile
+                out = await self.loop.run_in_executor(None, AtomicFile, file, shared)
+                out.setValidators(response.headers)
+                try:
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        await self.loop.run_in_executor(None, out.write, chunk)
+                    await self.loop.run_in_executor(None, out.commit)
+                except BaseException:
+                    out.discard()
+                    raise
+                return response.status, out, None
+        return await self.request(url, attempt)
+
+    async def post(self, url, data, headers=None):
+        '''
+        POSTs data and returns (status_code, body), retried like every other request.
+        '''
+        async def attempt(url):
+            if not self.http:
+                response = await self.loop.run_in_executor(None, functools.partial(session.post, url, data=data, headers={**DEFAULT_HEADERS, **(headers or {})}))
+                return response.status_code, response.content, retryAfter(response.headers)
+            async with self.http.post(url, data=data, headers=headers, proxy=self.proxy) as response:
+                return response.status, await response.read(), retryAfter(response.headers)
+        return await self.request(url, attempt)
+
+    async def size(self, url):
+        '''
+        Returns (status_code, size in bytes or None) of url from a one byte range request, so nothing is downloaded.
+        '''
+        headers = {"Range": "bytes=0-0"}
+
+        def total(status, response_headers):
+            content_range = response_headers.get("Content-Range", "")
+            if "/" in content_range and content_range.split("/")[-1].isdigit():
+                return int(content_range.split("/")[-1])
+            if status == 200 and response_headers.get("Content-Length", "").isdigit():
+                return int(response_headers["Content-Length"])
+            return None
+
+        async def attempt(url):
+            if not self.http:
+                def blocking():
+                    with session.get(url, headers={**DEFAULT_HEADERS, **headers}, stream=True, timeout=(30, 60)) as response:
+                        return response.status_code, total(response.status_code, response.headers), retryAfter(response.headers)
+                return await self.loop.run_in_executor(None, blocking)
+            async with self.http.get(url, headers=headers, proxy=self.proxy) as response:
+                return response.status, total(response.status, response.headers), retryAfter(response.headers)
+        return await self.request(url, attempt)
+
+    async def get(self, url):
+        '''
+        GETs a small resource into memory and returns (status_code, body).
+        '''
+        async def attempt(url):
+            if not self.http:
+                response = await self.loop.run_in_executor(None, functools.partial(session.get, url, headers=DEFAULT_HEADERS))
+                return response.status_code, response.content, retryAfter(response.headers)
+            async with self.http.get(url, proxy=self.proxy) as response:
+                return response.status, await response.read(), retryAfter(response.headers)
+        return await self.request(url, attempt)
+
+    def close(self):
+        if self.http:
+            self.run(self.http.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+DOWNLOAD_ENGINE = None
+DOWNLOAD_ENGINE_LOCK = threading.Lock()
+
+
+def getEngine():
+    global DOWNLOAD_ENGINE
+    with DOWNLOAD_ENGINE_LOCK:
+        if DOWNLOAD_ENGINE is None:
+            DOWNLOAD_ENGINE = DownloadEngine(MAX_CONNECTIONS)
+    return DOWNLOAD_ENGINE
+
+
+TEMP_SUFFIXES = (".part", ".link")  # AtomicFile and linkFile temporaries, never part of an archive
+
+
+def syncDir(directory):
+    # A rename is only durable once the directory holding it is synced; not possible on Windows, which needs no help
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def sweepTempFiles(root):
+    '''
+    Deletes the temporaries a crashed or killed run left in the archive at root, returns how many there were.
+    Only one run downloads into an archive at a time, so every one found is stale.
+    '''
+    removed = 0
+    for directory, _, files in os.walk(root):
+        for name in files:
+            if name.endswith(TEMP_SUFFIXES):
+                try:
+                    os.unlink(os.path.join(directory, name))
+                    removed += 1
+                except OSError:
+                    pass
+    if removed:
+        logging.info(f"Removed {removed} partial files left by an interrupted run")
+    return removed
+
+
+class AtomicFile:
+    '''
+    Writes to a temporary .part file next to file, commit() syncs it and renames it into place.
+    An interrupted download never leaves anything under the final name. With shared set and a BLOB_STORE open the
+    contents go into the store and file is linked to them instead, fetchIntoArchive only sets it for release assets.
+    '''
+
+    def __init__(self, file, shared=False):
+        fd, self.tmp = tempfile.mkstemp(dir=os.path.dirname(file) or ".", prefix=os.path.basename(file) + ".", suffix=".part")
+        self.file = file
+        self.shared = shared
+        self.f = os.fdopen(fd, "wb")
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.etag = None
+        self.last_modified = None
+
+    def setValidators(self, headers):
+        # Kept in the manifest so --update can revalidate the file with a conditional GET
+        self.etag = headers.get("ETag")
+        self.last_modified = headers.get("Last-Modified")
+
+    def write(self, chunk):
+        self.f.write(chunk)
+        self.size += len(chunk)
+        self.sha256.update(chunk)
+
+    def commit(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        if BLOB_STORE and self.shared:
+            BLOB_STORE.materialize(BLOB_STORE.add(self.tmp, self.sha256.hexdigest()), self.file)
+        else:
+            os.replace(self.tmp, self.file)
+        syncDir(os.path.dirname(self.file) or ".")
+
+    def discard(self):
+        self.f.close()
+        try:
+            os.unlink(self.tmp)
+        except OSError:
+            pass
+
+
+def reflinkFile(src, dst):
+    # Copy-on-write clone (btrfs, xfs), only available on linux
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    FICLONE = 0x40049409
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            return True
+        except OSError:
+            return False
+
+
+def linkFile(src, dst):
+    '''
+    Makes dst share src's contents, hardlinking where possible and falling back to a reflink and then a copy.
+    dst is replaced atomically so readers never see a partial file.
+    '''
+    tmp = f"{dst}.{uuid.uuid4().hex}.link"
+    try:
+        os.link(src, tmp)
+    except OSError:
+        if not reflinkFile(src, tmp):
+            shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+BLOB_STORE = None
+BLOB_STORE_LOCK = threading.Lock()
+
+
+class BlobStore:
+    '''
+    Content-addressed store of the files on IMMUTABLE_HOSTS, the showcase release assets (fonts, js, locale,
+    webgl-vendors, images) every archive shares.  Each is kept once under <root>/<sha256[:2]>/<sha256>, indexed by url so
+    it is only fetched once per release rather than once per tour, and materialized into archives with linkFile.
+    '''
+    IMMUTABLE_HOSTS = ["static.matterport.com"]
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        makeDirs(self.root)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(self.root, "urls.sqlite"), check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, sha256 TEXT, size INTEGER)")
+        self.db.commit()
+        self.fetch_locks = {}
+
+    def path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def add(self, tmp, sha256):
+        # Moves a finished download into the store, returns the blob path
+        blob = self.path(sha256)
+        if os.path.exists(blob):
+            os.unlink(tmp)
+        else:
+            makeDirs(os.path.dirname(blob))
+            shutil.move(tmp, blob)
+        return blob
+
+    def materialize(self, blob, file):
+        linkFile(blob, file)
+
+    def cacheKey(self, url):
+        parsed = urlparse(url)
+        if parsed.hostname in self.IMMUTABLE_HOSTS:
+            return f"{parsed.hostname}{parsed.path}"
+        return None
+
+    def lookup(self, url):
+        '''
+        Returns (sha256, size) of an already stored immutable url, or None.
+        '''
+        key = self.cacheKey(url)
+        if not key:
+            return None
+        with self.lock:
+            row = self.db.execute("SELECT sha256, size FROM urls WHERE url = ?", (key,)).fetchone()
+        if row and os.path.exists(self.path(row[0])):
+            return row
+        return None
+
+    def fetchLock(self, url):
+        # Only used from the engine loop, one lock per immutable url
+        key = self.cacheKey(url)
+        if not key:
+            return None
+        if key not in self.fetch_locks:
+            self.fetch_locks[key] = asyncio.Lock()
+        return self.fetch_locks[key]
+
+    def remember(self, url, sha256, size):
+        key = self.cacheKey(url)
+        if key:
+            with self.lock:
+                self.db.execute("INSERT OR REPLACE INTO urls VALUES (?, ?, ?)", (key, sha256, size))
+                self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def openBlobStore(root):
+    global BLOB_STORE
+    with BLOB_STORE_LOCK:
+        if BLOB_STORE is None or BLOB_STORE.root != os.path.abspath(root):
+            BLOB_STORE = BlobStore(root)
+    return BLOB_STORE
+
+
+MISSING_CACHE = None
+MISSING_CACHE_LOCK = threading.Lock()
+MISSING_CACHE_FILE = ".missing.sqlite"
+MISSING_STATUSES = {404, 410}
+
+
+class MissingFileError(Exception):
+    '''
+    Raised by downloadFile when the server answered that the file does not exist, rather than failing to serve it.
+    cached is set when the missing cache answered instead, nothing was requested.
+    '''
+
+    def __init__(self, message, cached=False):
+        Exception.__init__(self, message)
+        self.cached = cached
+
+
+class MissingCache:
+    '''
+    Persistent record of urls that came back 404, so reruns and other tours skip them without a round trip.
+    Entries are keyed by url pattern (no query string, cdn-<n> hosts folded together) and showcase release, and
+    expire after ttl seconds or as soon as the runtime hash changes, since a new build may add the asset.
+    '''
+
+    def __init__(self, file, ttl):
+        self.file = os.path.abspath(file)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.file, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS missing (pattern TEXT, release TEXT, status INTEGER, checked REAL, PRIMARY KEY (pattern, release))")
+        self.db.execute("DELETE FROM missing WHERE checked < ?", (time.time() - ttl,))
+        self.db.commit()
+        self.known = {}
+
+    def pattern(self, url):
+        # Access tokens are dropped, other parameters (crop, width, ...) select a different resource and are kept
+        parsed = urlparse(url)
+        host = re.sub(r'^cdn-\d+\.', 'cdn-*.', parsed.hostname or "")
+        query = "&".join(part for part in parsed.query.split("&") if part and not part.startswith(("t=", "k=")))
+        return f"{host}{parsed.path}?{query}" if query else f"{host}{parsed.path}"
+
+    def entries(self, release):
+        # All live patterns of one release, loaded once so lookups need no query
+        if release not in self.known:
+            with self.lock:
+                rows = self.db.execute("SELECT pattern FROM missing WHERE release = ? AND checked >= ?", (release, time.time() - self.ttl)).fetchall()
+            self.known[release] = {pattern for (pattern,) in rows}
+        return self.known[release]
+
+    def has(self, url, release):
+        return self.pattern(url) in self.entries(release)
+
+    def record(self, url, release, status):
+        pattern = self.pattern(url)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO missing VALUES (?, ?, ?, ?)", (pattern, release, status, time.time()))
+            self.db.commit()
+        self.entries(release).add(pattern)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def openMissingCache(file):
+    global MISSING_CACHE
+    with MISSING_CACHE_LOCK:
+        if MISSING_CACHE is None or MISSING_CACHE.file != os.path.abspath(file):
+            MISSING_CACHE = MissingCache(file, MISSING_CACHE_TTL)
+    return MISSING_CACHE
+
+
+@functools.lru_cache(maxsize=None)
+def environSettings(origin):
+    # The proxies and CA bundle session.get would look up in the environment for urls on origin (scheme://host)
+    return session.merge_environment_settings(origin, {}, True, None, None)
+
+
+def fetchBlocking(url, file, headers=None, shared=False):
+    # Fallback for DownloadEngine.fetch when aiohttp is not installed, runs on a worker thread.  Sent with the
+    # environment settings of its origin, session.get would read the whole environment again for every tile
+    parsed = urlparse(url)
+    prepared = session.prepare_request(requests.Request("GET", url, headers={**DEFAULT_HEADERS, **(headers or {})}))
+    with session.send(prepared, timeout=(30, 60), **environSettings(f"{parsed.scheme}://{parsed.netloc}")) as response:
+        if response.status_code >= 400 or response.status_code == 304:
+            return response.status_code, None, retryAfter(response.headers)
+        out = AtomicFile(file, shared)
+        out.setValidators(response.headers)
+        try:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                out.write(chunk)
+            out.commit()
+        except BaseException:
+            out.discard()
+            raise
+        return response.status_code, out, None
+
+
+MANIFEST_FILE = "download_manifest.sqlite"
+
+
+class Manifest:
+    '''
+    SQLite record of every file fetched into an archive: url, local path, size, sha256, HTTP status and time.
+    Reruns consult it instead of stat-ing every candidate path, rows are committed as each download finishes so a crashed run resumes where it stopped.
+    '''
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(self.root, MANIFEST_FILE), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, url TEXT, size INTEGER, sha256 TEXT, status INTEGER, fetched REAL, etag TEXT, last_modified TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS rewrites (path TEXT PRIMARY KEY, rules TEXT, sha256 TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS injections (operation TEXT PRIMARY KEY, signature TEXT, offset INTEGER, length INTEGER)")
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(files)")}
+        for column in ("etag", "last_modified"):
+            if column not in columns:  # manifests written before --update existed
+                self.db.execute(f"ALTER TABLE files ADD COLUMN {column} TEXT")
+        self.db.commit()
+        self.done = {path for (path,) in self.db.execute("SELECT path FROM files WHERE status < 400")}
+
+    def key(self, file):
+        return os.path.relpath(os.path.abspath(file), self.root).replace(os.sep, "/")
+
+    def has(self, file):
+        return self.key(file) in self.done
+
+    def record(self, url, file, status, size=None, sha256=None, etag=None, last_modified=None):
+        key = self.key(file)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (key, url, size, sha256, status, time.time(), etag, last_modified))
+            self.db.commit()
+            if status < 400:
+                self.done.add(key)
+            else:
+                self.done.discard(key)
+
+    def validators(self, file):
+        '''
+        Returns the conditional request headers for revalidating an archived file, empty if nothing was recorded.
+        '''
+        with self.lock:
+            row = self.db.execute("SELECT etag, last_modified FROM files WHERE path = ? AND status < 400", (self.key(file),)).fetchone()
+        headers = {}
+        if row and row[0]:
+            headers["If-None-Match"] = row[0]
+        if row and row[1]:
+            headers["If-Modified-Since"] = row[1]
+        return headers
+
+    def revalidated(self, file):
+        with self.lock:
+            self.db.execute("UPDATE files SET fetched = ? WHERE path = ?", (time.time(), self.key(file)))
+            self.db.commit()
+
+    def rewritten(self, file):
+        # (rules fingerprint, sha256) of file as the last rewriteFile left it, None if it never rewrote it
+        with self.lock:
+            return self.db.execute("SELECT rules, sha256 FROM rewrites WHERE path = ?", (self.key(file),)).fetchone()
+
+    def recordRewrite(self, file, rules, sha256):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO rewrites VALUES (?, ?, ?)", (self.key(file), rules, sha256))
+            self.db.commit()
+
+    def injections(self):
+        # Where each graph query sits in index.html: {operation: (graph file signature, offset, length)}
+        with self.lock:
+            return {operation: (signature, offset, length) for operation, signature, offset, length in self.db.execute("SELECT * FROM injections")}
+
+    def recordInjections(self, spans):
+        with self.lock:
+            self.db.execute("DELETE FROM injections")
+            self.db.executemany("INSERT INTO injections VALUES (?, ?, ?, ?)", [(operation, *span) for operation, span in spans.items()])
+            self.db.commit()
+
+    def adopt(self, url, file):
+        # Files downloaded before the manifest existed, trusted once and recorded so later runs need no stat
+        self.record(url, file, 200, os.path.getsize(file))
+
+    def verify(self):
+        '''
+        Re-hashes every recorded file and forgets the ones that are missing or changed so the next run fetches them again.
+        Files patched after download (showcase.js, index.html) are checked against what the last rewrite left behind.
+        Returns the number of entries dropped.
+        '''
+        dropped = 0
+        rows = self.db.execute("SELECT path, size, sha256 FROM files WHERE status < 400").fetchall()
+        rewrites = dict(self.db.execute("SELECT path, sha256 FROM rewrites"))
+        for path, size, sha256 in tqdm(rows, desc="Verifying"):
+            file = os.path.join(self.root, path)
+            if path in rewrites:
+                size, sha256 = None, rewrites[path]
+            try:
+                ok = size is None or os.path.getsize(file) == size
+                if ok and sha256:
+                    digest = hashlib.sha256()
+                    with open(file, "rb") as f:
+                        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                            digest.update(chunk)
+                    ok = digest.hexdigest() == sha256
+            except OSError:
+                ok = False
+            if not ok:
+                logging.warning(f'Manifest entry {path} is missing or does not match, will download again')
+                with self.lock:
+                    self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+                    self.done.discard(path)
+                dropped += 1
+        self.db.commit()
+        return dropped
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def openManifest(root):
+    manifest = Manifest(root)
+    if VERIFY_MANIFEST:
+        dropped = manifest.verify()
+        print(f"Verified manifest, {dropped} files will be downloaded again")
+    return manifest
+
+
+async def downloadFileAsync(url, file):
+    job = currentJob()
+    manifest = job.manifest if job else None
 
-    if "/" in file:
-        makeDirs(os.path.dirname(file))
     if "?" in file:
         file = file.split('?')[0]
+    file = jobPath(file)
+    if "/" in file:
+        makeDirs(os.path.dirname(file))
 
-    # Skip already downloaded files except index.html, which may have newer access keys
-    if os.path.exists(file):
+    # Skip files the manifest or the archive already has, unless --update revalidates them
+    headers = None
+    if UPDATE_ARCHIVE and job and job.mutable(url, file) and os.path.exists(file):
+        # --update revalidates the api json and changed sweeps instead of trusting the archived copy
+        headers = manifest.validators(file) if manifest else {}
+    elif manifest and manifest.has(file):
         logging.debug(f'Skipping url: {url} as already downloaded')
         return
-    try:
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.5790.110 Safari/537.36",
-            "Referer": "https://my.matterport.com/",
-        }
-        response = session.get(url, headers=headers)
-        response.raise_for_status()  # Raise an exception if the response has an error status code
-
-        with open(file, 'wb') as f:
-            f.write(response.content)
-        logging.debug(f'Successfully downloaded: {url} to: {file}')
-    except requests.exceptions.HTTPError as err:
-        logging.warning(f'URL error Handling {url} or will try alt: {str(err)}')
-
-        # Try again with different accessurls (very hacky!)
-        if "?t=" in url:
-            for accessurl in accessurls:
-                url2 = ""
-                try:
-                    url2 = f"{url.split('?')[0]}?{accessurl}"
-                    response = session.get(url2, headers=headers)
-                    response.raise_for_status()  # Raise an exception if the response has an error status code
+    elif os.path.exists(file):
+        logging.debug(f'Skipping url: {url} as already downloaded')
+        if manifest:
+            manifest.adopt(url, file)
+        return
+    if MISSING_CACHE and MISSING_CACHE.has(url, job.release if job else ""):
+        # raised rather than returned, probes that walk indices until one is missing stop here as on the first run
+        raise MissingFileError(f'Skipping url: {url} as it was missing on a previous run', cached=True)
+
+    lock = BLOB_STORE.fetchLock(url) if BLOB_STORE else None
+    if lock:
+        # Another tour in a batch may be fetching this release asset right now, wait for it and link its copy
+        async with lock:
+            await fetchIntoArchive(url, file, headers)
+    else:
+        await fetchIntoArchive(url, file, headers)
+
+
+async def fetchIntoArchive(url, file, headers=None):
+    engine = getEngine()
+    job = currentJob()
+    manifest = job.manifest if job else None
+
+    stored = BLOB_STORE.lookup(url) if BLOB_STORE else None
+    if stored:
+        sha256, size = stored
+        BLOB_STORE.materialize(BLOB_STORE.path(sha256), file)
+        logging.debug(f'Linked {url} to: {file} from the blob store')
+        if manifest:
+            manifest.record(url, file, 200, size, sha256)
+        return
+
+    tokens = job.tokens if job else None
+    if tokens and tokens.expiring():
+        await tokens.refresh()
+    routes = tokens.routes(url) if tokens else [url]
+    # Only release assets go into the blob store, tiles and sweeps belong to one tour and would never be pruned from it
+    shared = bool(BLOB_STORE and BLOB_STORE.cacheKey(url))
+    refreshed = False
+    for route in routes:
+        status, out = await engine.fetch(route, file, headers, shared)
+        if status in (401, 403) and tokens and not refreshed and "?t=" in route:
+            # Token expired under us, get a new one and re-issue this request with it
+            refreshed = True
+            if await tokens.refresh(route):
+                route = tokens.apply(route)
+                status, out = await engine.fetch(route, file, headers, shared)
+        if status == 304:
+            logging.debug(f'Not modified: {route}, keeping {file}')
+            if manifest:
+                manifest.revalidated(file)
+            return
+        if status < 400:
+            logging.debug(f'Successfully downloaded: {route} to: {file}')
+            if tokens:
+                tokens.learn(route)
+            if BLOB_STORE:
+                BLOB_STORE.remember(url, out.sha256.hexdigest(), out.size)
+            if manifest:
+                manifest.record(route, file, status, out.size, out.sha256.hexdigest(), out.etag, out.last_modified)
+            return
+        if status in MISSING_STATUSES:
+            if MISSING_CACHE:
+                MISSING_CACHE.record(url, job.release if job else "", status)
+            break  # the file does not exist, other access urls will not have it either
+        logging.warning(f'URL error Handling {route} or will try alt: HTTP {status}')
+    logging.error(f'Failed to succeed for url {url}')
+    if manifest:
+        manifest.record(url, file, status)
+    if status in MISSING_STATUSES:
+        raise MissingFileError(f'Failed to download {url}: HTTP {status}')
+    raise Exception(f'Failed to download {url}')
 
-                    with open(file, 'wb') as f:
-                        f.write(response.content)
-                    logging.debug(f'Successfully downloaded through alt: {url2} to: {file}')
+
+def downloadFile(url, file, post_data=None):
+    getEngine().run(downloadFileAsync(url, file))
+    job = currentJob()
+    if job and job.plan:
+        # Single files are what discovery reads, a --plan run fetches them and lists them as already present
+        job.plan.add(job, [(url, file)], "Discovery")
+
+
+async def downloadFilesAsync(jobs, desc=None, total=None):
+    engine = getEngine()
+    if total is None and hasattr(jobs, "__len__"):
+        total = len(jobs)
+    # jobs may be a lazy generator, the queue keeps only a couple of batches of it in memory at a time
+    queue = asyncio.Queue(maxsize=engine.max_connections * 2)
+    failed = 0
+    done = 0  # counted here, a disabled progress bar does not count
+    job = currentJob()
+    if desc and job:
+        desc = f"{job.pageid} {desc}"
+    last_postfix = 0
+    with tqdm(total=total, desc=desc, disable=desc is None) as pbar:
+        async def worker():
+            nonlocal failed, done, last_postfix
+            while True:
+                job = await queue.get()
+                if job is None:
                     return
-                except requests.exceptions.HTTPError as err:
-                    logging.warning(f'URL error alt method tried url {url2} Handling of: {str(err)}')
-                    pass
-        logging.error(f'Failed to succeed for url {url}')
-        raise Exception
-        # Hopefully not getting here?
-        logging.error(f'Failed2 to succeed for url {url}')
+                url, file = job
+                try:
+                    await downloadFileAsync(url, file)
+                except MissingFileError as ex:
+                    if not ex.cached:
+                        failed += 1
+                    logging.debug(str(ex))
+                except Exception as ex:
+                    failed += 1
+                    logging.debug(f'Exception downloading file: {url} of: {str(ex)}')
+                finally:
+                    done += 1
+                    pbar.update(1)
+                    if time.monotonic() - last_postfix > 0.5:
+                        last_postfix = time.monotonic()
+                        pbar.set_postfix_str(engine.describeLimits(), refresh=False)
+
+        workers = [asyncio.create_task(worker()) for _ in range(engine.max_connections)]
+        for job in jobs:
+            await queue.put(job)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    if failed:
+        logging.warning(f'{failed} of {done} downloads failed' + (f' in {desc}' if desc else ''))
+    return failed
+
+
+def downloadFiles(jobs, desc=None, total=None, discovery=False):
+    '''
+    Downloads every (url, file) pair in jobs concurrently through the engine and returns the number that failed.
+    jobs can be a generator, it is consumed through a bounded queue. Pass desc to show a progress bar that advances as downloads finish.
+    During a --plan run the jobs are only written to the plan, unless discovery says later steps need to read them.
+    '''
+    job = currentJob()
+    if job and job.plan:
+        jobs = list(jobs)
+        failed = getEngine().run(downloadFilesAsync(jobs, desc, total)) if discovery else 0
+        job.plan.add(job, jobs, "Discovery" if discovery else desc or "Files")
+        return failed
+    return getEngine().run(downloadFilesAsync(jobs, desc, total))
+
+
+PLAN_SAMPLES = 4  # size probes per kind of file in each planned stage
+
+
+def planStratum(file):
+    # Files expected to be about the same size: same folder once ids are masked, same tile depth, same extension
+    name = os.path.basename(file)
+    depth = name.split("_face")[0] if "_face" in name else ""
+    folder = re.sub(r'[0-9a-f]{32}', '*', os.path.dirname(file))
+    return f"{folder}|{depth}|{os.path.splitext(name)[1]}"
+
+
+class DownloadPlan:
+    '''
+    Output of --plan: one JSON line per file a download would fetch, with its archive path and size.
+    Sizes of files not in the archive yet are estimated from a few one-byte range requests per kind of file.
+    The file can be given back to --from-plan to download exactly what was listed.
+    '''
+
+    def __init__(self, file):
+        self.file = file
+        self.lock = threading.Lock()
+        self.out = open(file, "w", encoding="UTF-8")
+        self.stages = {}  # stage -> [files, bytes, bytes already in archives]
+
+    def add(self, job, jobs, stage):
+        entries = []
+        for url, file in jobs:
+            file = file.split('?')[0]
+            local = jobPath(file)
+            # archive relative, the plan is read on other machines with the archive somewhere else
+            if os.path.isabs(file):
+                file = os.path.relpath(file, job.root).replace(os.sep, "/")
+            # the release the tour is served with, so --from-plan runs remember 404s under the same one
+            entry = {"pageid": job.pageid, "stage": stage, "url": url, "file": file, "release": job.release}
+            if os.path.exists(local):
+                # a file the manifest lists but that was deleted since is planned like any other
+                entry.update(size=os.path.getsize(local), exists=True)
+            elif MISSING_CACHE and MISSING_CACHE.has(url, job.release):
+                entry.update(size=0, missing=True)
+            entries.append(entry)
+        getEngine().run(self.estimate(job, [entry for entry in entries if "size" not in entry]))
+        with self.lock:
+            totals = self.stages.setdefault(stage, [0, 0, 0])
+            for entry in entries:
+                self.out.write(json.dumps(entry) + "\n")
+                totals[0] += 1
+                totals[1] += entry["size"]
+                if entry.get("exists"):
+                    totals[2] += entry["size"]
+            self.out.flush()
+
+    async def estimate(self, job, entries):
+        strata = {}
+        for entry in entries:
+            strata.setdefault(planStratum(entry["file"]), []).append(entry)
+        engine = getEngine()
+
+        async def probe(entry):
+            status, size = await engine.size(job.tokens.apply(entry["url"]))
+            if status in MISSING_STATUSES:
+                return 0
+            return size
+
+        for group in strata.values():
+            samples = random.sample(group, min(PLAN_SAMPLES, len(group)))
+            sizes = await asyncio.gather(*(probe(entry) for entry in samples), return_exceptions=True)
+            for entry, size in zip(samples, sizes):
+                if isinstance(size, int):
+                    entry["size"] = size
+            known = [entry["size"] for entry in samples if "size" in entry]
+            average = int(sum(known) / len(known)) if known else 0
+            for entry in group:
+                if "size" not in entry:
+                    entry.update(size=average, estimated=True)
+
+    def close(self):
+        with self.lock:
+            self.out.close()
+        total = sum(totals[1] for totals in self.stages.values())
+        present = sum(totals[2] for totals in self.stages.values())
+        for stage, (files, size, _) in self.stages.items():
+            print(f"{stage:>10}: {files} files, {size / 1024 / 1024:.1f} MB")
+        print(f"Plan written to {self.file}: {total / 1024 / 1024:.1f} MB, {(total - present) / 1024 / 1024:.1f} MB of it still to download")
+
+
+PLAN_RELEASES = {}  # pageid -> showcase release its --plan was made with
+
+
+def readPlan(file, shard=None):
+    '''
+    Returns {pageid: [(url, file), ...]} of the entries of a --plan file that still need downloading, and keeps each
+    tour's showcase release in PLAN_RELEASES.
+    With shard, an (index, count) pair from --shard, only the entries that shard is responsible for are returned.
+    '''
+    jobs = {}
+    entries = []
+    with open(file, "r", encoding="UTF-8") as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                jobs.setdefault(entry["pageid"], [])
+                # entries planned before the runtime was read have no release yet
+                if entry.get("release"):
+                    PLAN_RELEASES[entry["pageid"]] = entry["release"]
+                if not entry.get("exists") and not entry.get("missing"):
+                    entries.append(entry)
+    if shard:
+        entries = shardEntries(entries, *shard)
+    for entry in entries:
+        jobs[entry["pageid"]].append((entry["url"], entry["file"]))
+    return jobs
+
+
+def parseShard(arg):
+    index, _, count = arg.partition("/")
+    index, count = int(index), int(count)
+    if not 1 <= index <= count:
+        raise ValueError(f'--shard takes i/K with 1 <= i <= K, got {arg}')
+    return index, count
+
+
+def shardEntries(entries, index, count):
+    '''
+    Splits plan entries into count shards of about equal bytes and returns shard index (1 based).
+    Largest first into the lightest shard, ordered by size then path, so every machine reading the same plan gets the same split.
+    '''
+    loads = [0] * count
+    mine = []
+    for entry in sorted(entries, key=lambda entry: (-entry.get("size", 0), entry["pageid"], entry["file"])):
+        shard = loads.index(min(loads))
+        loads[shard] += entry.get("size", 0)
+        if shard == index - 1:
+            mine.append(entry)
+    logging.info(f'Shard {index}/{count} has {len(mine)} of {len(entries)} planned files, {loads[index - 1]} bytes')
+    return mine
+
+
+def shardRoot(downloads_dir, pageid, shard):
+    # Each shard downloads into its own staging tree next to the archive, --merge moves them into it
+    if not shard:
+        return os.path.join(downloads_dir, pageid)
+    return os.path.join(downloads_dir, f"{pageid}.shard{shard[0]}of{shard[1]}")
+
+
+def mergeShards(pageid, downloads_dir="downloads"):
+    '''
+    Moves the files of every staging tree of pageid into its archive, going by their manifests.
+    A path that two shards, or a shard and the archive, hold with different contents is a conflict: it is reported and
+    left alone, and the staging trees are kept so it can be looked at. Returns the number of conflicts.
+    '''
+    root = os.path.join(downloads_dir, pageid)
+    makeDirs(root)
+    archive = Manifest(root)
+    shard_dirs = sorted(glob.glob(os.path.join(downloads_dir, glob.escape(pageid) + ".shard*of*")))
+    chosen = {}  # path -> (sha256, shard dir, row)
+    conflicted = set()  # paths two shards disagree on, none of their copies is linked
+    conflicts = 0
+    for shard_dir in shard_dirs:
+        if not os.path.exists(os.path.join(shard_dir, MANIFEST_FILE)):
+            logging.warning(f'{shard_dir} has no manifest, skipping it')
+            continue
+        db = sqlite3.connect(os.path.join(shard_dir, MANIFEST_FILE))
+        rows = db.execute("SELECT path, url, size, sha256, status, fetched, etag, last_modified FROM files WHERE status < 400").fetchall()
+        db.close()
+        for row in rows:
+            path, sha256 = row[0], row[3]
+            if path in conflicted:
+                continue
+            if path in chosen:
+                # rows adopted without hashing have no sha256, they can only be compared with nothing
+                if chosen[path][0] and sha256 and chosen[path][0] != sha256:
+                    logging.error(f'Merge conflict for {pageid}/{path}: {chosen[path][1]} and {shard_dir} differ')
+                    conflicts += 1
+                    conflicted.add(path)
+                    del chosen[path]
+                elif sha256 and not chosen[path][0]:
+                    chosen[path] = (sha256, shard_dir, row)
+                continue
+            chosen[path] = (sha256, shard_dir, row)
+    with archive.lock:
+        existing = dict(archive.db.execute("SELECT path, sha256 FROM files WHERE status < 400").fetchall())
+    merged = 0
+    for path, (sha256, shard_dir, row) in chosen.items():
+        if path in existing and existing[path] and sha256 and existing[path] != sha256:
+            logging.error(f'Merge conflict for {pageid}/{path}: the archive already has different contents')
+            conflicts += 1
+            continue
+        src = os.path.join(shard_dir, path)
+        if not os.path.exists(src):
+            logging.warning(f'{src} is in the shard manifest but missing, skipping it')
+            continue
+        dst = os.path.join(root, path)
+        makeDirs(os.path.dirname(dst))
+        linkFile(src, dst)
+        archive.record(row[1], dst, row[4], row[2], sha256, row[6], row[7])
+        merged += 1
+    archive.close()
+    print(f"Merged {merged} files from {len(shard_dirs)} shards into {pageid}" + (f", {conflicts} conflicts" if conflicts else ""))
+    if not conflicts:
+        for shard_dir in shard_dirs:
+            shutil.rmtree(shard_dir)
+    return conflicts
+
+
+GRAPH_URL = "https://my.matterport.com/api/mp/models/graph"
+GRAPH_HEADERS = {"Content-Type": "application/json", "x-matterport-application-name": "showcase"}
+GRAPH_BATCHING = None  # whether the graph endpoint answers a list of operations in one POST, None until tried
+GRAPH_BATCHING_FILE = ".graph_batching.json"  # in downloads/, remembers a rejected batch across runs
+GRAPH_BATCHING_TTL = 30 * 24 * 3600  # seconds until a rejected batch is tried again, the endpoint may have changed
+GRAPH_BATCHING_STATE = None  # path of the loaded GRAPH_BATCHING_FILE
+
+
+def loadGraphBatching(file):
+    global GRAPH_BATCHING, GRAPH_BATCHING_STATE
+    GRAPH_BATCHING_STATE = file
+    try:
+        with open(file, encoding="UTF-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return
+    if GRAPH_BATCHING is None and state.get("batching") is False and time.time() - state.get("checked", 0) < GRAPH_BATCHING_TTL:
+        logging.debug('Graph endpoint rejected a batch before, posting operations one at a time')
+        GRAPH_BATCHING = False
 
 
-def downloadGraphModels(pageid):
-    global GRAPH_DATA_REQ
-    makeDirs("api/mp/models")
+async def recordGraphBatching(batching):
+    global GRAPH_BATCHING
+    if GRAPH_BATCHING is batching:
+        return
+    GRAPH_BATCHING = batching
+    if not GRAPH_BATCHING_STATE:
+        return
 
-    for key in GRAPH_DATA_REQ:
-        file_path = f"api/mp/models/graph_{key}.json"
-        downloadFileWithJSONPost(
-            "https://my.matterport.com/api/mp/models/graph", file_path, GRAPH_DATA_REQ[key], key)
+    def write():
+        out = AtomicFile(GRAPH_BATCHING_STATE)
+        out.write(json.dumps({"batching": batching, "checked": time.time()}).encode("UTF-8"))
+        out.commit()
+    await getEngine().loop.run_in_executor(None, write)
+
+
+async def writeGraphResponse(key, body):
+    # Not shared with the blob store, patchGetModelDetails edits some of these in place
+    file = jobPath(f"api/mp/models/graph_{key}.json")
+
+    def write():
+        out = AtomicFile(file, shared=False)
+        out.write(body)
+        out.commit()
+    await getEngine().loop.run_in_executor(None, write)
+    logging.debug(f'Successfully downloaded w/ JSON post to: {GRAPH_URL} ({key})')
+
+
+async def postGraphBatch(requests_by_key):
+    '''
+    Sends every operation in one POST as a JSON list, the way Apollo style servers batch queries.
+    Returns the keys still to be posted one at a time: all of them when the endpoint does not answer with one result
+    per operation, which is remembered across runs, else those whose result came back with errors.
+    '''
+    keys = list(requests_by_key)
+    body = "[" + ",".join(requests_by_key[key] for key in keys) + "]"
+    status, content = await getEngine().post(GRAPH_URL, body.encode("UTF-8"), GRAPH_HEADERS)
+    try:
+        results = json.loads(content) if status < 400 else None
+    except ValueError:
+        results = None
+    if not isinstance(results, list) or len(results) != len(keys):
+        logging.info(f'Graph endpoint does not batch operations (HTTP {status}), posting them one at a time')
+        await recordGraphBatching(False)
+        return keys
+    await recordGraphBatching(True)
+    failed = []
+    for key, result in zip(keys, results):
+        if not isinstance(result, dict) or "errors" in result:
+            failed.append(key)
+            continue
+        await writeGraphResponse(key, json.dumps(result).encode("UTF-8"))
+    if failed:
+        logging.info(f'Batched graph queries {", ".join(failed)} came back with errors, posting them one at a time')
+    return failed
+
+
+async def postGraphOperation(key, body):
+    status, content = await getEngine().post(GRAPH_URL, body.encode("UTF-8"), GRAPH_HEADERS)
+    if status >= 400:
+        raise Exception(f'Graph query {key} failed: HTTP {status}')
+    await writeGraphResponse(key, content)
+
+
+async def downloadGraphModelsAsync(pageid):
+    job = currentJob()
+    makeDirs(job.path("api/mp/models"))
+    # Cached responses are kept unless --update asks for fresh ones
+    pending = {key: body for key, body in job.graph_data_req.items()
+               if UPDATE_ARCHIVE or not os.path.exists(job.path(f"api/mp/models/graph_{key}.json"))}
+    skipped = len(job.graph_data_req) - len(pending)
+    if skipped:
+        logging.debug(f'Skipping {skipped} graph queries as already downloaded')
+    if not pending:
+        return
+    if len(pending) > 1 and GRAPH_BATCHING is not False:
+        pending = {key: pending[key] for key in await postGraphBatch(pending)}
+    results = await asyncio.gather(*(postGraphOperation(key, body) for key, body in pending.items()), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logging.error(str(result))
 
-def parseRuntimeJS(content):
-    """
-    Parses the runtime.js content to extract the chunk mapping.
-    Returns a list of (chunk_id, chunk_name, chunk_hash) tuples.
-    """
-    chunks = []
-    
-    # Regex to find the name mapping: {239:"three-examples",...}
-    # It usually appears in: n.u=e=>"js/"+({239:"three-examples",...}[e]||e)+"."
-    name_map_match = re.search(r'n\.u=e=>"js/"\+\(({.*?)}\[e\]\|\|e\)', content)
-    name_map = {}
-    if name_map_match:
-        # Parse the dictionary string: 239:"three-examples",777:"split"
-        pairs = name_map_match.group(1).split(',')
-        for pair in pairs:
-            if ':' in pair:
-                k, v = pair.split(':')
-                name_map[k.strip()] = v.strip('"')
-
-    # Regex to find the hash mapping: +{235:"ebe436e0...",...}[e]+".js"
-    # Regex to find the hash mapping: +{235:"ebe436e0...",...}[e]+".js"
-    # Matches: +"."+{...}[e]+".js"
-    # The content usually has: ...+"."+{...}[e]+".js"...
-    # We need to match the dictionary inside the curly braces.
-    
-    logging.info(f"Runtime JS content start: {content[:500]}")
-    
-    # Robust regex handling different quotes and whitespace
-    # Matches: + "." + {dictionary} [e] + ".js"
-    # We use re.DOTALL just in case
-    hash_map_match = re.search(r'\+\s*["\']\.["\']\s*\+\s*({.*?})\s*\[e\]\s*\+\s*["\']\.js["\']', content, re.DOTALL)
-    
-    if not hash_map_match:
-         logging.info("First regex failed, trying loose match")
-         # Match just the dictionary followed by [e]+".js"
-         hash_map_match = re.search(r'({[\w\d]+:"[a-f0-9]+".*?})\[e\]\+"\.js"', content, re.DOTALL)
-
-    hash_map = {}
-    if hash_map_match:
-        # Strip curly braces from the captured group
-        content_str = hash_map_match.group(1).strip('{}')
-        pairs = content_str.split(',')
-        for pair in pairs:
-            if ':' in pair:
-                k, v = pair.split(':')
-                hash_map[k.strip()] = v.strip('"')
-
-    # Combine them. Note: not all chunks have names, some just use ID.
-    # The hash map usually contains all chunks.
-    for chunk_id, chunk_hash in hash_map.items():
-        chunk_name = name_map.get(chunk_id, chunk_id) # Default to ID if no name
-        chunks.append((chunk_id, chunk_name, chunk_hash))
-
-    return chunks
-
-def parseRuntimeCSS(content):
-    """
-    Parses the runtime.js content to extract the CSS chunk mapping.
-    """
-    # n.miniCssF=e=>"css/"+({5385:"init",...}[e]||e)+".css"
-    # n.miniCssF=e=>"css/"+({5385:"init",...}[e]||e)+".css"
-    name_map_match = re.search(r'n\.miniCssF=e=>"css/"\+\(({.*?)}\[e\]\|\|e\)\+"\.css"', content)
-    name_map = {}
-    if name_map_match:
-        pairs = name_map_match.group(1).split(',')
-        for pair in pairs:
-            if ':' in pair:
-                k, v = pair.split(':')
-                name_map[k.strip()] = v.strip('"')
-
-    # Find all chunks that have CSS
-    # n.f.miniCss=(r,a)=>{... {1442:1,5385:1,...}[r] ...}
-    # We look for the object with keys having value 1 inside n.f.miniCss
-    css_chunks_match = re.search(r'n\.f\.miniCss=.*?\s*({[\d:,]+})\s*\[r\]', content, re.DOTALL)
-    
-    css_chunks = []
-    if css_chunks_match:
-        chunk_ids_str = css_chunks_match.group(1).strip('{}')
-        pairs = chunk_ids_str.split(',')
-        for pair in pairs:
-            if ':' in pair:
-                chunk_id, _ = pair.split(':')
-                chunk_id = chunk_id.strip()
-                # Resolve name: use map if exists, else use ID
-                chunk_name = name_map.get(chunk_id, chunk_id)
-                css_chunks.append(chunk_name)
-    
-    # Fallback: if we couldn't find the list, at least return the named ones we found
-    if not css_chunks and name_map:
-        css_chunks = list(name_map.values())
 
-    return css_chunks
+def downloadGraphModels(pageid):
+    getEngine().run(downloadGraphModelsAsync(pageid))
+
+# The runtime assigns the chunk filename functions and the css chunk set as properties of the webpack require function:
+#   n.u=e=>"js/"+({239:"three-examples",...}[e]||e)+"."+{235:"ebe436e0...",...}[e]+".js"
+#   n.miniCssF=e=>"css/"+({5385:"init",...}[e]||e)+".css"
+#   n.f.miniCss=(r,a)=>{... {1442:1,5385:1,...}[r]&&a.push(...) ...}
+RUNTIME_SITE = re.compile(r'\.(u|miniCssF|f\.miniCss)\s*=(?![=>])')
+# a { after one of these starts an object literal, anywhere else (after ) or =>) it opens a block
+RUNTIME_EXPRESSION_START = "([,:=+?!&|"
+RUNTIME_ATOM = r'''"[^"\\]*+(?:\\.[^"\\]*+)*+"|'[^'\\]*+(?:\\.[^'\\]*+)*+'|[\w$.+-]++'''
+RUNTIME_PAIR = re.compile(rf'\s*({RUNTIME_ATOM})\s*:\s*({RUNTIME_ATOM})\s*,?')
+# a flat object literal, optionally looked up right away with [x] and falling back with || (the name maps)
+RUNTIME_LOOKUP = r'(?P<lookup>\s*\[\s*[\w$]+\s*\](?P<fallback>\s*\|\|)?)?'
+RUNTIME_LITERAL = re.compile(rf'\{{(?>\s*(?:{RUNTIME_ATOM})\s*:\s*(?:{RUNTIME_ATOM})\s*,?)*+\s*\}}{RUNTIME_LOOKUP}')
+# the same with only number keys (the minifier writes 5000 as 5e3) and digit or double quoted values without quotes,
+# commas or colons in them, what current builds emit.  Every , and : in one of those separates pairs, so they are split
+# with str methods instead of a regex per pair.  The exponent group keeps the last exponent key seen, only then do
+# keys have to be rewritten
+RUNTIME_PLAIN_LITERAL = re.compile(rf'\{{(?:\d++(?:(?P<exponent>e)\d++)?:(?:"[^"\\,:]*+"|\d++),?)*+\}}{RUNTIME_LOOKUP}')
+RUNTIME_NUMBER = re.compile(r'0[xX][0-9a-fA-F]+|\d+(?:\.\d*)?(?:[eE][+-]?\d+)?')
+RUNTIME_ESCAPE = re.compile(r'\\(.)')
+
+
+def runtimeValue(atom):
+    '''
+    Unquotes strings and prints numbers the way javascript does for object keys, so 5e3 and 0x1388 both become "5000".
+    '''
+    if atom.isdigit():
+        return atom
+    if atom[0] in "\"'":
+        return RUNTIME_ESCAPE.sub(r'\1', atom[1:-1]) if "\\" in atom else atom[1:-1]
+    if not RUNTIME_NUMBER.fullmatch(atom):
+        return atom
+    value = int(atom, 16) if atom[:2] in ("0x", "0X") else float(atom)
+    return str(int(value)) if value == int(value) else str(value)
+
+
+def runtimeLiteral(content, literal):
+    end = literal.start("lookup") if literal.group("lookup") else literal.end()
+    if literal.re is RUNTIME_PLAIN_LITERAL:
+        items = content[literal.start() + 1:content.rindex("}", 0, end)].replace('"', "").replace(":", ",").split(",")
+        pairs = zip(items[::2], items[1::2])  # a trailing comma leaves one item over, zip drops it
+        if literal.group("exponent"):
+            return {runtimeValue(k) if "e" in k else k: v for k, v in pairs}
+        return dict(pairs)
+    # digit keys and plain double quoted values are nearly all of them, keep those off the slow path
+    return {k if k.isdigit() else runtimeValue(k): v[1:-1] if v[0] == '"' and "\\" not in v else runtimeValue(v)
+            for k, v in RUNTIME_PAIR.findall(content, literal.start() + 1, end)}
+
+
+def parseRuntime(content):
+    '''
+    Extracts the chunk maps from a webpack runtime (runtime~showcase.js) in one pass over the file.
+    Returns (js_chunks, css_chunks): js_chunks a list of (chunk_id, chunk_name, chunk_hash) and css_chunks a list of names,
+    chunks without a name use their id as webpack does.
+    '''
+    js_names, js_hashes, css_names, css_ids = {}, {}, {}, []
+    site = RUNTIME_SITE.search(content)
+    while site:
+        following = RUNTIME_SITE.search(content, site.end())
+        limit = following.start() if following else len(content)
+        wanted = site.group(1)
+        pos = site.end()
+        # the maps are the first literals of their assignment, stop looking once they are found or the next one starts
+        while wanted:
+            brace = content.find("{", pos, limit)
+            if brace < 0:
+                break
+            pos = brace + 1
+            before = brace - 1
+            while before > 0 and content[before].isspace():
+                before -= 1
+            if content[before] not in RUNTIME_EXPRESSION_START and not content.endswith("return", 0, before + 1):
+                continue
+            literal = RUNTIME_PLAIN_LITERAL.match(content, brace) or RUNTIME_LITERAL.match(content, brace)
+            if not literal:
+                continue
+            pos = literal.end()
+            indexed, fallback = literal.group("lookup") is not None, literal.group("fallback") is not None
+            if wanted == "u" and indexed:
+                (js_names if fallback else js_hashes).update(runtimeLiteral(content, literal))
+                wanted = wanted if fallback else None
+            elif wanted == "miniCssF" and fallback:
+                css_names.update(runtimeLiteral(content, literal))
+                wanted = None
+            elif wanted == "f.miniCss" and indexed:
+                css_ids.extend(key for key, value in runtimeLiteral(content, literal).items() if value not in ("0", "false"))
+                wanted = None
+        if following and following.start() < pos:
+            following = RUNTIME_SITE.search(content, pos)
+        site = following
+    if not js_hashes:
+        logging.warning("Could not find the js chunk map in the runtime, only the directly referenced files will be downloaded")
+    js_chunks = [(chunk_id, js_names.get(chunk_id, chunk_id), chunk_hash) for chunk_id, chunk_hash in js_hashes.items()]
+    css_chunks = [css_names.get(chunk_id, chunk_id) for chunk_id in css_ids] or list(css_names.values())
+    return js_chunks, css_chunks
 
 
 def downloadStaticReferencedAssets(html_content, base_url):
@@ -271,34 +1871,34 @@ def downloadStaticReferencedAssets(html_content, base_url):
     matches = re.findall(r'<link[^>]+href=["\']([^"\']+)["\']', html_content)
     urls.extend(matches)
     
-    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
-        for asset in urls:
-            if asset.startswith("http") or asset.startswith("//") or asset.startswith("data:"):
-                continue
-            
-            # Clean query params for local filename
-            local_file = asset.split('?')[0]
+    jobs = []
+    for asset in urls:
+        if asset.startswith("http") or asset.startswith("//") or asset.startswith("data:"):
+            continue
+        
+        # Clean query params for local filename
+        local_file = asset.split('?')[0]
+        
+        # Construct full URL
+        if base_url.endswith("/") and asset.startswith("/"):
+            full_url = base_url[:-1] + asset
+        elif not base_url.endswith("/") and not asset.startswith("/"):
+            full_url = base_url + "/" + asset
+        else:
+            full_url = base_url + asset
             
-            # Construct full URL
-            if base_url.endswith("/") and asset.startswith("/"):
-                full_url = base_url[:-1] + asset
-            elif not base_url.endswith("/") and not asset.startswith("/"):
-                full_url = base_url + "/" + asset
-            else:
-                full_url = base_url + asset
-                
-            executor.submit(downloadFile, full_url, local_file)
+        jobs.append((full_url, local_file))
+    downloadFiles(jobs)
 
 def downloadAssets(base, runtime_content):
     
-    # 1. Parse runtime.js for JS chunks
-    js_chunks = parseRuntimeJS(runtime_content)
+    # 1. Parse runtime.js for the JS and CSS chunks
+    js_chunks, css_chunks = parseRuntime(runtime_content)
     js_files = []
     for _, name, hash_val in js_chunks:
         js_files.append(f"js/{name}.{hash_val}.js")
 
-    # 2. Parse runtime.js for CSS chunks
-    css_chunks = parseRuntimeCSS(runtime_content)
+    # 2. CSS chunks
     css_files = []
     for name in css_chunks:
         css_files.append(f"css/{name}.css")
@@ -351,39 +1951,39 @@ def downloadAssets(base, runtime_content):
     for lc in language_codes:
         assets.append("locale/messages/strings_" + lc + ".json")
         
-    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
-        for asset in assets:
-            local_file = asset
-            if local_file.endswith('/'):
-                local_file = local_file + "index.html"
-            executor.submit(downloadFile, f"{base}{asset}", local_file)
+    jobs = []
+    for asset in assets:
+        local_file = asset
+        if local_file.endswith('/'):
+            local_file = local_file + "index.html"
+        jobs.append((f"{base}{asset}", local_file))
+    downloadFiles(jobs, desc="Assets")
 
 def downloadWebglVendors(urls):
-    for url in urls:      
-        path= url.replace('https://static.matterport.com/','')
-        downloadFile(url, path)
+    downloadFiles((url, url.replace('https://static.matterport.com/','')) for url in urls)
 
 def setAccessURLs(pageid):
-    global accessurls
-    with open(f"api/player/models/{pageid}/files_type2", "r", encoding="UTF-8") as f:
+    job = currentJob()
+    with open(job.path(f"api/player/models/{pageid}/files_type2"), "r", encoding="UTF-8") as f:
         filejson = json.load(f)
-        accessurls.append(filejson["base.url"].split("?")[-1])
-    with open(f"api/player/models/{pageid}/files_type3", "r", encoding="UTF-8") as f:
+        job.tokens.alternates.append(filejson["base.url"].split("?")[-1])
+    with open(job.path(f"api/player/models/{pageid}/files_type3"), "r", encoding="UTF-8") as f:
         filejson = json.load(f)
-        accessurls.append(filejson["templates"][0].split("?")[-1])
+        job.tokens.alternates.append(filejson["templates"][0].split("?")[-1])
 
 
 def downloadInfo(pageid):
     assets = [f"api/v1/jsonstore/model/highlights/{pageid}", f"api/v1/jsonstore/model/Labels/{pageid}", f"api/v1/jsonstore/model/mattertags/{pageid}", f"api/v1/jsonstore/model/measurements/{pageid}",
         f"api/v1/player/models/{pageid}/thumb?width=1707&dpr=1.5&disable=upscale", f"api/v1/player/models/{pageid}/", f"api/v2/models/{pageid}/sweeps", "api/v2/users/current", f"api/player/models/{pageid}/files", f"api/v1/jsonstore/model/trims/{pageid}", "api/v1/plugins?manifest=true"]
-    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
-        for asset in assets:
-            local_file = asset
-            if local_file.endswith('/'):
-                local_file = local_file + "index.html"
-            executor.submit(downloadFile, f"https://my.matterport.com/{asset}", local_file)
-    makeDirs("api/mp/models")
-    with open(f"api/mp/models/graph", "w", encoding="UTF-8") as f:
+    jobs = []
+    for asset in assets:
+        local_file = asset
+        if local_file.endswith('/'):
+            local_file = local_file + "index.html"
+        jobs.append((f"https://my.matterport.com/{asset}", local_file))
+    downloadFiles(jobs, discovery=True)
+    makeDirs(jobPath("api/mp/models"))
+    with open(jobPath("api/mp/models/graph"), "w", encoding="UTF-8") as f:
         f.write('{"data": "empty"}')
     for i in range(1, 4):
         downloadFile(
@@ -392,27 +1992,192 @@ def downloadInfo(pageid):
 
 
 def downloadPics(pageid):
-    with open(f"api/v1/player/models/{pageid}/index.html", "r", encoding="UTF-8") as f:
+    with open(jobPath(f"api/v1/player/models/{pageid}/index.html"), "r", encoding="UTF-8") as f:
         modeldata = json.load(f)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
-        for image in modeldata["images"]:
-            executor.submit(downloadFile, image["src"], urlparse(
-                image["src"]).path[1:])
+    downloadFiles((image["src"], urlparse(image["src"]).path[1:]) for image in modeldata["images"])
 
 
-def downloadModel(pageid, accessurl, mesh_accessurl=None):
+def readModelData(pageid):
+    try:
+        with open(jobPath(f"api/v1/player/models/{pageid}/index.html"), "r", encoding="UTF-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def diffSweeps(previous, modeldata, model_dir):
+    '''
+    Returns the sweeps of modeldata that --update has to fetch: ones added or changed since the archived model data,
+    and ones with no tiles in the archive at all (an earlier run that was interrupted). Changed sweeps are marked for
+    revalidation since their tiles keep the same names.
+    '''
+    job = currentJob()
+    old_sweeps = previous.get("sweeps") or {}
+    sweeps = {}
+    added = changed = 0
+    for sweep, info in modeldata["sweeps"].items():
+        if sweep not in old_sweeps:
+            added += 1
+        elif old_sweeps[sweep] != info:
+            changed += 1
+            job.revalidate.append(f'{model_dir}/tiles/{sweep.replace("-", "")}/')
+        elif os.path.isdir(jobPath(f'{model_dir}/tiles/{sweep.replace("-", "")}')):
+            continue
+        sweeps[sweep] = info
+    print(f"{added} sweeps added, {changed} changed, {len(modeldata['sweeps']) - len(sweeps)} unchanged")
+    return sweeps
+
+
+def downloadModel(pageid, accessurl, mesh_accessurl=None, previous=None):
+    '''
+    Downloads the mesh, textures and sweep tiles. With previous, the model data from before an --update, only the
+    sweeps and mesh that differ from it are fetched.
+    '''
     global ADVANCED_DOWNLOAD_ALL
     if not mesh_accessurl:
         mesh_accessurl = accessurl
 
-    with open(f"api/v1/player/models/{pageid}/index.html", "r", encoding="UTF-8") as f:
-        modeldata = json.load(f)
+    beginPhase("mesh")
+    modeldata = readModelData(pageid)
     accessid = re.search(
         r'models/([a-z0-9-_./~]*)/\{filename\}', accessurl).group(1)
-    makeDirs(f"models/{accessid}")
-    os.chdir(f"models/{accessid}")
-    downloadUUID(mesh_accessurl, modeldata["job"]["uuid"])
-    downloadSweeps(accessurl, modeldata["sweeps"])
+    max_depth = getTileDepthHint(pageid)
+    model_dir = f"models/{accessid}"
+    makeDirs(jobPath(model_dir))
+    mesh_uuid = modeldata["job"]["uuid"]
+    sweeps = modeldata["sweeps"]
+    if previous:
+        sweeps = diffSweeps(previous, modeldata, model_dir)
+    if previous and previous.get("job", {}).get("uuid") == mesh_uuid and os.path.exists(jobPath(f'{model_dir}/{mesh_uuid}_50k.dam')):
+        print("Mesh unchanged")
+        texture_jobs = []
+    else:
+        texture_jobs = downloadUUID(mesh_accessurl, mesh_uuid, model_dir)
+    beginPhase("sweeps")
+    downloadSweeps(accessurl, sweeps, model_dir, max_depth, texture_jobs)
+    if ADVANCED_DOWNLOAD_ALL:
+        beginPhase("crops")
+        textures = [file.rsplit("/", 1)[-1] for _, file in texture_jobs if "_texture_jpg_high/" in file]
+        downloadCrops(mesh_accessurl, mesh_uuid, model_dir, textures)
+
+
+class Rewriter:
+    '''
+    Applies a table of (name, pattern, replacement) rules to a text in one pass and reports how often each matched.
+    Patterns are literal strings or compiled regexes (give those a literal prefix so they are found quickly).  This is
+    not a single streaming multi-pattern pass: each pattern gets its own native str.find / finditer scan, so a pass costs
+    one C-level scan per rule, and the matches are merged in position order and the output is joined once.  Where matches
+    overlap the one starting first wins, on a tie the earlier rule.  Replacements are literal and may not match any rule
+    themselves, but a replacement next to the surrounding text can still form a new match (static-host turns
+    '"https://static.matterport.com/api/mp/' into '"/api/mp/' for api-path), so passes repeat until nothing matches and
+    rewriting an already rewritten text changes nothing.
+    '''
+
+    def __init__(self, rules):
+        self.rules = rules
+        patterns = [pattern.pattern if isinstance(pattern, re.Pattern) else pattern for _, pattern, _ in rules]
+        self.fingerprint = hashlib.sha256(json.dumps([(name, pattern, replacement) for (name, _, replacement), pattern in zip(rules, patterns)]).encode()).hexdigest()
+        for name, _, replacement in rules:
+            for other, pattern, _ in rules:
+                if self.matches(pattern, replacement):
+                    raise ValueError(f"Rewrite rule {name} is not idempotent, its replacement matches rule {other}")
+
+    @staticmethod
+    def matches(pattern, text):
+        return pattern.search(text) is not None if isinstance(pattern, re.Pattern) else pattern in text
+
+    @staticmethod
+    def spans(index, pattern, text):
+        if isinstance(pattern, re.Pattern):
+            for match in pattern.finditer(text):
+                yield match.start(), index, match.end()
+            return
+        start = text.find(pattern)
+        while start >= 0:
+            yield start, index, start + len(pattern)
+            start = text.find(pattern, start + len(pattern))
+
+    def rewrite(self, text):
+        '''
+        Returns (rewritten text, {rule name: matches}), the text itself when no rule matched.
+        '''
+        counts = collections.Counter()
+        # a pass can leave new matches at the edges of its replacements, so repeat until a pass finds nothing; still
+        # matching after more passes than there are rules means the rules keep feeding each other
+        for _ in range(len(self.rules) + 1):
+            text, found = self.rewritePass(text)
+            if not found:
+                return text, counts
+            counts.update(found)
+        raise ValueError(f"Rewrite rules do not settle, still matching {', '.join(found)} after {len(self.rules) + 1} passes")
+
+    def rewritePass(self, text):
+        counts = collections.Counter()
+        parts = []
+        pos = 0
+        for start, index, end in heapq.merge(*(self.spans(index, pattern, text) for index, (_, pattern, _) in enumerate(self.rules))):
+            if start < pos:
+                continue  # inside a match that started earlier
+            name, _, replacement = self.rules[index]
+            parts.append(text[pos:start])
+            parts.append(replacement)
+            pos = end
+            counts[name] += 1
+        if not counts:
+            return text, counts
+        parts.append(text[pos:])
+        return "".join(parts), counts
+
+
+def rewriteFile(file, rewriter):
+    '''
+    Rewrites file in place with rewriter and returns the rule counts.  Files are only rewritten when something matched,
+    and the manifest remembers what each rewrite left behind so a rerun skips files that have not changed since.
+    '''
+    with open(file, "rb") as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    job = CURRENT_JOB.get()
+    manifest = job.manifest if job else None
+    if manifest and manifest.rewritten(file) == (rewriter.fingerprint, digest):
+        logging.debug(f"{file} unchanged since it was last patched")
+        return collections.Counter()
+    text, counts = rewriter.rewrite(data.decode("UTF-8"))
+    if counts:
+        # Replace rather than rewrite in place, the file may be hardlinked to the shared blob store
+        out = AtomicFile(file, shared=False)
+        out.write(text.encode("UTF-8"))
+        out.commit()
+        digest = out.sha256.hexdigest()
+    if manifest:
+        manifest.recordRewrite(file, rewriter.fingerprint, digest)
+    logRewrite(file, rewriter, counts)
+    return counts
+
+
+def logRewrite(name, rewriter, counts):
+    matched = ", ".join(f"{rule} x{count}" for rule, count in counts.items())
+    logging.info(f"Patched {os.path.basename(name)}: {matched or 'nothing to change'}")
+    unmatched = [rule for rule, _, _ in rewriter.rules if rule not in counts]
+    if counts and unmatched:
+        logging.debug(f"Rules that did not match in {name}: {', '.join(unmatched)}")
+
+
+# showcase.js: drop the token expiry check and make api/static urls relative to wherever the archive is served from
+SHOWCASE_REWRITER = Rewriter([
+    ("token-expiry", re.compile(r"\&\&\(!e.expires\|\|.{1,10}\*e.expires>Date.now\(\)\)"), ""),
+    ("api-path", '"/api/mp/', '`${window.location.pathname}`+"api/mp/'),
+    ("base-url", "${this.baseUrl}", "${window.location.origin}${window.location.pathname}"),
+    ("geoip", 'e.get("https://static.matterport.com/geoip/",{responseType:"json",priority:i.RequestPriority.LOW})',
+     '{"country_code":"US","country_name":"united states","region":"CA","city":"los angeles"}'),
+    ("static-host", "https://static.matterport.com", ""),
+])
+
+# graph_*.json: files from the local server instead of the cdn, and links that never expire
+GRAPH_REWRITER = Rewriter([
+    ("cdn-host", "https://cdn-2.matterport.com", "http://127.0.0.1:8080"),
+    ("valid-until", re.compile(r'"validUntil"\s*:\s*"(?!2099-01-01T)20\d{2}-\d{2}-\d{2}T'), '"validUntil":"2099-01-01T'),
+])
 
 
 # Patch showcase.js to fix expiration issue
@@ -420,47 +2185,24 @@ def patchShowcase():
     global SHOWCASE_INTERNAL_NAME
     
     # Find the actual showcase file we downloaded
-    showcase_files = [f for f in os.listdir("js") if f.startswith("showcase.") and f.endswith(".js")]
+    showcase_files = [f for f in os.listdir(jobPath("js")) if f.startswith("showcase.") and f.endswith(".js")]
     if not showcase_files:
         logging.error("Could not find downloaded showcase.js file to patch")
         return
     
     # Use the first one found (should be only one main showcase file)
     SHOWCASE_INTERNAL_NAME = showcase_files[0]
-    logging.info(f"Patching {SHOWCASE_INTERNAL_NAME}")
-
-    with open(f"js/{SHOWCASE_INTERNAL_NAME}", "r", encoding="UTF-8") as f:
-        j = f.read()
-    j = re.sub(r"\&\&\(!e.expires\|\|.{1,10}\*e.expires>Date.now\(\)\)", "", j)
-    j = j.replace(f'"/api/mp/', '`${window.location.pathname}`+"api/mp/')
-    j = j.replace("${this.baseUrl}",
-                  "${window.location.origin}${window.location.pathname}")
-    j = j.replace('e.get("https://static.matterport.com/geoip/",{responseType:"json",priority:i.RequestPriority.LOW})',
-                  '{"country_code":"US","country_name":"united states","region":"CA","city":"los angeles"}')
-    j = j.replace('https://static.matterport.com','')
-    
-    # Also patch the runtime to point to local chunks if needed, but usually relative paths work.
-    # However, we might need to ensure publicPath is correct.
-    
-    with open(f"js/{SHOWCASE_INTERNAL_NAME}", "w", encoding="UTF-8") as f:
-        f.write(j)
+    rewriteFile(jobPath(f"js/{SHOWCASE_INTERNAL_NAME}"), SHOWCASE_REWRITER)
 
 
 # Patch (graph_GetModelDetails.json & graph_GetSnapshots.json) URLs to Get files form local server instead of https://cdn-2.matterport.com/
 def patchGetModelDetails():
-    localServer = "http://127.0.0.1:8080"
-    
     files_to_patch = ["graph_GetModelDetails.json", "graph_GetSnapshots.json", "graph_GetModelViewPrefetch.json"]
     
     for filename in files_to_patch:
-        filepath = f"api/mp/models/{filename}"
+        filepath = jobPath(f"api/mp/models/{filename}")
         if os.path.exists(filepath):
-            with open(filepath, "r", encoding="UTF-8") as f:
-                j = f.read()
-            j = j.replace("https://cdn-2.matterport.com", localServer)
-            j = re.sub(r"validUntil\"\s:\s*\"20[\d]{2}-[\d]{2}-[\d]{2}T", "validUntil\":\"2099-01-01T", j)
-            with open(filepath, "w", encoding="UTF-8") as f:
-                f.write(j)
+            rewriteFile(filepath, GRAPH_REWRITER)
 
 
 def drange(x, y, jump):
@@ -469,75 +2211,75 @@ def drange(x, y, jump):
         x += decimal.Decimal(jump)
 
 
-validToken = None
-validKey = None
-KNOWN_ACCESS_KEY = None
-
-
 def GetOrReplaceKey(url, is_new=False):
-    global validToken
-    global validKey
+    job = currentJob()
+    if job is None:
+        return url
     if is_new:
-        match = re.search(r't=(.*?)&', url)
-        if match:
-            validToken = match.group(1)
-        match = re.search(r'k=(.*?)"', url)
-        if match:
-            validKey = match.group(1)
-
-    if validToken and validKey:
-        url = re.sub(r't=.*?&', f't={validToken}&', url)
-        url = re.sub(r'k=.*?$', f'k={validKey}', url)
-    return url
+        job.tokens.update(url)
+    return job.tokens.apply(url)
 
 
 
-def downloadPage(pageid):
-    global ADVANCED_DOWNLOAD_ALL
-    
+def downloadPage(pageid, planned=None):
+    '''
+    Downloads one tour into downloads/<pageid>. Everything tour specific lives in a TourJob rather than globals and
+    nothing changes the working directory, so several of these can run at once on different threads.
+    With planned, the (url, file) jobs read from a --plan file, only those are downloaded, into a staging tree
+    if this is one --shard of the plan.
+    '''
     # Create downloads directory if it doesn't exist
     downloads_dir = os.path.join(os.getcwd(), "downloads")
-    if not os.path.exists(downloads_dir):
-        os.makedirs(downloads_dir)
-        
-    page_root_dir = os.path.join(downloads_dir, pageid)
-    makeDirs(page_root_dir)
+    makeDirs(downloads_dir)
+    job = TourJob(pageid, shardRoot(downloads_dir, pageid, SHARD if planned is not None else None))
+    job.plan = DOWNLOAD_PLAN
+    makeDirs(job.root)
+    if BLOB_STORE_DIR:
+        openBlobStore(BLOB_STORE_DIR)
+    elif BLOB_STORE_DIR is None:
+        openBlobStore(os.path.join(downloads_dir, ".blobs"))
+    if MISSING_CACHE_TTL > 0:
+        openMissingCache(os.path.join(downloads_dir, MISSING_CACHE_FILE))
+    loadGraphBatching(os.path.join(downloads_dir, GRAPH_BATCHING_FILE))
+
+    # Load graph requests from repo root
+    job.graph_data_req = openDirReadGraphReqs(os.path.join(os.getcwd(), "graph_posts"), pageid)
+
+    token = CURRENT_JOB.set(job)
+    log_handler = logging.FileHandler(job.path("download.log"), mode='w', encoding="UTF-8")
+    log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s %(message)s'))
+    log_handler.addFilter(JobLogFilter(job))
+    logging.getLogger().addHandler(log_handler)
+    try:
+        sweepTempFiles(job.root)
+        job.manifest = openManifest(job.root)
+        if planned is not None:
+            downloadPlannedFiles(pageid, planned)
+        else:
+            downloadTourFiles(pageid)
+    except Exception as ex:
+        writeRunReport(job, ex)
+        raise
+    else:
+        writeRunReport(job)
+    finally:
+        if job.manifest:
+            job.manifest.close()
+        logging.getLogger().removeHandler(log_handler)
+        log_handler.close()
+        CURRENT_JOB.reset(token)
 
-    # Load graph requests from repo root before changing directory
-    graph_posts_dir = os.path.join(os.getcwd(), "graph_posts")
-    openDirReadGraphReqs(graph_posts_dir, pageid)
-    
-    # Change to the target directory immediately
-    original_cwd = os.getcwd()
-    os.chdir(page_root_dir)
-
-    ADV_CROP_FETCH = [
-        {
-                "start": "width=512&crop=1024,1024,",
-                "increment": '0.5'
-            },
-        {
-                "start": "crop=512,512,",
-                "increment": '0.25'
-            }
-    ]
 
-    import glob
-
-# Configure logging
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s %(levelname)-8s %(message)s',
-        handlers=[
-            logging.FileHandler("download.log", mode='w'),
-            logging.StreamHandler()
-        ]
-    )
+def downloadTourFiles(pageid):
+    global ADVANCED_DOWNLOAD_ALL
+    job = currentJob()
+
     logging.debug(f'Started up a download run')
     
     print("Downloading base page...")
+    beginPhase("page")
     url = f"https://my.matterport.com/show/?m={pageid}"
-    r = session.get(url)
+    r = session.get(rewriteUrl(url))
     r.encoding = "utf-8"
     
     # Find static base
@@ -546,6 +2288,8 @@ def downloadPage(pageid):
         staticbase = staticbase_match.group(1)
     else:
         raise Exception("Could not find static base URL")
+    release_match = re.search(r'js/runtime~showcase\.([a-f0-9]+)\.js', r.text)
+    job.release = release_match.group(1) if release_match else staticbase
 
     # Find Three.js (updated for module support)
     threeMin = re.search(
@@ -625,19 +2369,9 @@ def downloadPage(pageid):
         mesh_accessurl = accessurl # Fallback
 
     # get a valid access key, there are a few but this is a common client used one, this also makes sure it is fresh
-    file_type_content = requests.get(
-        f"https://my.matterport.com/api/player/models/{pageid}/files?type=3")
+    file_type_content = requests.get(rewriteUrl(
+        f"https://my.matterport.com/api/player/models/{pageid}/files?type=3"))
     GetOrReplaceKey(file_type_content.text, True)
-    if ADVANCED_DOWNLOAD_ALL:
-        print("Doing advanced download of dollhouse/floorplan data...")
-        # ... (rest of advanced download logic)
-        try:
-            if match: # Re-use the match from above if possible or re-parse
-                 # ... (existing logic)
-                 pass
-        except:
-            pass
-
 
     # Find and download runtime and showcase scripts first to parse them
     # Look for src="js/runtime~showcase.[hash].js"
@@ -648,7 +2382,7 @@ def downloadPage(pageid):
     if runtime_match:
         runtime_path = runtime_match.group(1)
         downloadFile(f"{staticbase}{runtime_path}", runtime_path)
-        with open(runtime_path, "r", encoding="UTF-8") as f:
+        with open(job.path(runtime_path), "r", encoding="UTF-8") as f:
             runtime_content = f.read()
     else:
         logging.warning("Could not find runtime~showcase.js")
@@ -660,103 +2394,162 @@ def downloadPage(pageid):
         logging.warning("Could not find showcase.js")
 
         
-    # Automatic redirect if GET param isn't correct
-    injectedjs = 'if (window.location.search != "?m=' + pageid + \
-                      '") { document.location.search = "?m=' + pageid + '"; }'
-    # Replace static base and remove external CDN URLs for local serving
-    # Use absolute URL for localhost to avoid Invalid URL errors in client
-    content = r.text.replace(staticbase, "http://localhost:8080/").replace(
-        "window.MP_PREFETCHED_MODELDATA", f"{injectedjs};window.MP_PREFETCHED_MODELDATA"
-    )
-    # Remove external CDN prefixes - for local serving we don't need them
-    # Use absolute URL for localhost to avoid Invalid URL errors in client
-    content = content.replace('"https://cdn-1.matterport.com/', '"http://localhost:8080/')
-    content = content.replace('"https://mp-app-prod.global.ssl.fastly.net/', '"http://localhost:8080/')
-    content = content.replace('"https://events.matterport.com/', '"http://localhost:8080/')
-    content = content.replace('"https://cdn-2.matterport.com/', '"http://localhost:8080/')
-    
-    if threeMin:
-        # Prepend ./ to the path for local module loading
-        content = content.replace(f'{threeMinUrl}', "./" + threeMinUrl.replace('https://static.matterport.com/',''))
-        
-    content = re.sub(r"validUntil\":\s*\"20[\d]{2}-[\d]{2}-[\d]{2}T", "validUntil\":\"2099-01-01T", content)
-
-    
-    # Inject client-side logging
-    content = injectClientLogger(content)
+    rewriter = indexRewriter(pageid, staticbase, threeMinUrl if threeMin else None)
+    content, counts = rewriter.rewrite(r.text)
+    logRewrite("index.html", rewriter, counts)
 
-    # Inject all graph data
-    content = injectGraphData(content, pageid)
-
-    with open("index.html", "w", encoding="UTF-8") as f:
+    with open(job.path("index.html"), "w", encoding="UTF-8") as f:
         f.write(content)
 
 
     print("Downloading static assets...")
+    beginPhase("assets")
     downloadAssets(staticbase, runtime_content)
     downloadStaticReferencedAssets(r.text, staticbase)
     downloadWebglVendors(webglVendors)
     # Patch showcase.js to fix expiration issue and some other changes for local hosting
     patchShowcase()
     print("Downloading model info...")
+    beginPhase("info")
+    previous = readModelData(pageid) if UPDATE_ARCHIVE else None
     downloadInfo(pageid)
     print("Downloading images...")
+    beginPhase("pics")
     downloadPics(pageid)
     print("Downloading graph model data...")
+    beginPhase("graph")
     downloadGraphModels(pageid)
     print(f"Patching graph_GetModelDetails.json URLs")
     patchGetModelDetails()
+    injectGraphData(pageid)
     print(f"Downloading model ID: {pageid} ...")
-    
-    # Create downloads directory if it doesn't exist
-    downloads_dir = os.path.join(os.getcwd(), "downloads")
-    if not os.path.exists(downloads_dir):
-        os.makedirs(downloads_dir)
-        
-    page_root_dir = os.path.join(downloads_dir, pageid)
-    makeDirs(page_root_dir)
-    
-    downloadModel(pageid, accessurl, mesh_accessurl)
-    # os.chdir(page_root_dir) # Already changed at start
-    makeDirs("api/v1")
-    open("api/v1/event", 'a').close()
+    downloadModel(pageid, accessurl, mesh_accessurl, previous)
+    makeDirs(job.path("api/v1"))
+    open(job.path("api/v1/event"), 'a').close()
     print("Done!")
 
 
 
+def downloadPlannedFiles(pageid, jobs):
+    # The discovery files a --plan run fetched are in the archive already, only the access token has to be fresh
+    job = currentJob()
+    job.release = PLAN_RELEASES.get(pageid, "")
+    file_type_content = requests.get(rewriteUrl(
+        f"https://my.matterport.com/api/player/models/{pageid}/files?type=3"))
+    GetOrReplaceKey(file_type_content.text, True)
+    if os.path.exists(job.path(f"api/player/models/{pageid}/files_type2")):
+        setAccessURLs(pageid)
+    print(f"Downloading {len(jobs)} planned files...")
+    beginPhase("planned")
+    downloadFiles(jobs, desc="Planned")
+    print("Done!")
+
+
 def initiateDownload(url):
     downloadPage(getPageId(url))
 
 
+def readBatchList(arg):
+    '''
+    --batch takes either a file with one url or page id per line (# starts a comment) or a comma separated list.
+    '''
+    if os.path.isfile(arg):
+        with open(arg, "r", encoding="UTF-8") as f:
+            entries = [line.split("#")[0] for line in f]
+    else:
+        entries = arg.split(",")
+    return [getPageId(entry.strip()) for entry in entries if entry.strip()]
+
+
+def downloadBatch(pageids, concurrent_tours=4, planned=None):
+    '''
+    Downloads several tours at once, each on its own thread with its own TourJob. They share the download engine's
+    connection pool and the blob store, so static assets of a showcase release are fetched once for the whole batch.
+    planned maps page ids to the jobs of a --plan file to download instead of the whole tour.
+    Returns the page ids that failed.
+    '''
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrent_tours) as executor:
+        futures = {executor.submit(downloadPage, pageid, planned[pageid] if planned else None): pageid for pageid in pageids}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as ex:
+                logging.error(f'Failed to download {futures[future]}: {str(ex)}')
+                failed.append(futures[future])
+    print(f"Downloaded {len(pageids) - len(failed)} of {len(pageids)} tours")
+    return failed
+
+
 def getPageId(url):
     return url.split("m=")[-1].split("&")[0]
 
 
 
-class OurSimpleHTTPRequestHandler(SimpleHTTPRequestHandler):
-    def send_error(self, code, message=None):
-        if code == 404:
-            logging.warning(
-                f'404 error: {self.path} may not be downloading everything right')
-        SimpleHTTPRequestHandler.send_error(self, code, message)
+SERVER_IDLE_TIMEOUT = 30  # seconds an idle keep-alive connection keeps its thread before the server closes it
+SERVER_WORKERS = 1  # --workers, processes sharing the port through SO_REUSEPORT
+WORKER_START_GRACE = 2  # seconds, a worker failing sooner than this after its start (ie the port is taken) is not restarted
+ARCHIVE_WATCH_INTERVAL = 5  # seconds between checks of the archive for changes that need a new index, 0 disables them
 
+LOCALE_FALLBACK = "/locale/strings.json"
 
-    def do_GET(self):
-        global SHOWCASE_INTERNAL_NAME
-        redirect_msg = None
-        orig_request = self.path
-
-        # Handle showcase.js redirection if the name is different
-        if self.path.startswith("/js/showcase.js") and not os.path.exists(f".{self.path}"):
-             # Try to find the actual showcase file
-             if os.path.exists(f"js/{SHOWCASE_INTERNAL_NAME}"):
-                redirect_msg = f"using our internal {SHOWCASE_INTERNAL_NAME} file"
-                self.path = f"/js/{SHOWCASE_INTERNAL_NAME}"
-
-        if self.path.startswith("/locale/messages/strings_") and not os.path.exists(f".{self.path}"):
-            redirect_msg = "original request was for a locale we do not have downloaded"
-            self.path = "/locale/strings.json"
-        raw_path, _, query = self.path.partition('?')
+
+def contentType(path):
+    ext = os.path.splitext(path)[1]
+    res = SimpleHTTPRequestHandler.extensions_map.get(ext) or SimpleHTTPRequestHandler.extensions_map.get(ext.lower()) or mimetypes.guess_type(path)[0] or "application/octet-stream"
+    if res == "text/html":
+        return "text/html; charset=UTF-8"
+    return res
+
+
+class ArchiveIndex:
+    '''
+    Everything the server needs to answer a request for the archive in the current directory without touching the
+    filesystem before it opens the file: each file's path, size, mtime and content type by url path, including directory
+    index pages and the /js/showcase.js alias, and the graph operations with an archived response.  Crop variants and
+    locale fallbacks resolve against the same table.  Built before --workers forks so every worker shares one copy, and
+    again on SIGHUP or once changed() sees the archive change.
+    '''
+
+    def __init__(self):
+        self.files = {}  # url path: (file path, size, mtime, content type)
+        self.dirs = {}  # directory: st_mtime_ns when indexed, a file added, removed or renamed in it changes it
+        # set by the handler when a file it opened no longer matches its entry; in shared memory, so with --workers the
+        # master watching the archive sees what a worker found
+        self.stale = multiprocessing.Value("b", False, lock=False)
+        self.scan(".")
+        self.showcase = min((url[len("/js/"):] for url in self.files if url.startswith("/js/showcase.") and url.endswith(".js")), default=None)
+        self.aliases = {}  # url path: (url path of the file served, why)
+        if self.showcase and "/js/showcase.js" not in self.files:
+            self.aliases["/js/showcase.js"] = (f"/js/{self.showcase}", f"using our internal {self.showcase} file")
+        prefix = "/api/mp/models/graph_"
+        self.graphs = {url[len(prefix):-len(".json")]: self.files[url] for url in self.files if url.startswith(prefix) and url.endswith(".json")}
+
+    def scan(self, directory):
+        try:
+            self.dirs[directory] = os.stat(directory).st_mtime_ns
+            with os.scandir(directory) as entries:
+                entries = list(entries)
+        except FileNotFoundError:
+            return  # removed while indexing, the next check sees the change
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    self.scan(entry.path)
+                elif entry.is_file() and not entry.name.endswith(TEMP_SUFFIXES):
+                    stat = entry.stat()
+                    url = entry.path[1:].replace(os.sep, "/")
+                    self.files[url] = (entry.path, stat.st_size, stat.st_mtime, contentType(entry.name))
+                    if entry.name == "index.html":
+                        self.files[url[:-len("index.html")]] = self.files[url]
+            except FileNotFoundError:
+                continue
+
+    def resolve(self, raw_path, query):
+        '''
+        Returns (url path, entry, why) for the file a request is answered with, entry None when the archive has no
+        file for it; why is set when that is not the file asked for.
+        '''
         if "crop=" in query and raw_path.endswith(".jpg"):
             query_args = urllib.parse.parse_qs(query)
             crop_addition = query_args.get("crop", None)
@@ -771,42 +2564,369 @@ class OurSimpleHTTPRequestHandler(SimpleHTTPRequestHandler):
             else:
                 width_addition = ''
             test_path = raw_path + width_addition + crop_addition + ".jpg"
-            if os.path.exists(f".{test_path}"):
-                self.path = test_path
-                redirect_msg = "dollhouse/floorplan texture request that we have downloaded, better than generic texture file"
-        if redirect_msg is not None or orig_request != self.path:
-            logging.info(
-                f'Redirecting {orig_request} => {self.path} as {redirect_msg}')
+            entry = self.files.get(test_path)
+            if entry:
+                return test_path, entry, "dollhouse/floorplan texture request that we have downloaded, better than generic texture file"
+        entry = self.files.get(raw_path)
+        if entry:
+            return raw_path, entry, None
+        if "%" in raw_path:
+            entry = self.files.get(urllib.parse.unquote(raw_path))
+            if entry:
+                return raw_path, entry, None
+        if raw_path in self.aliases:
+            url, why = self.aliases[raw_path]
+            return url, self.files[url], why
+        if raw_path.startswith("/locale/messages/strings_") and LOCALE_FALLBACK in self.files:
+            return LOCALE_FALLBACK, self.files[LOCALE_FALLBACK], "original request was for a locale we do not have downloaded"
+        return raw_path, None, None
+
+    def changed(self):
+        if self.stale.value:
+            return True
+        try:
+            return any(os.stat(directory).st_mtime_ns != mtime for directory, mtime in self.dirs.items())
+        except OSError:
+            return True
+
+
+SERVER_INDEX = None
+
+
+RESPONSE_CACHE_SIZE = 64 * 1024 * 1024  # --cache-size in MB, bytes of responses each server process keeps in memory, 0 disables the cache
+GZIP_MIN_SIZE = 1024  # smaller responses are not worth a compressed copy
+COMPRESSIBLE_TYPES = {"application/javascript", "application/json", "image/svg+xml"}  # besides text/*
+CACHE_STATS_PATH = "/_matterport_dl/cache"  # GET returns the answering process's cache counters as json
+
+
+def acceptsGzip(accept_encoding):
+    '''
+    Whether an Accept-Encoding header allows gzip: listed (or covered by *) with a q-value above 0, so "gzip;q=0" and
+    "*;q=0" refuse it and an explicit gzip entry wins over *.
+    '''
+    wildcard = None
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        name = name.strip().lower()
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name in ("gzip", "x-gzip"):
+            return quality > 0
+        if name == "*":
+            wildcard = quality > 0
+    return bool(wildcard)
+
+
+class CachedResponse:
+    '''
+    A response body with its header lines encoded once, and a gzip copy with its own headers for compressible types.
+    '''
+    __slots__ = ("head", "body", "gzip_head", "gzip_body", "size")
+
+    def __init__(self, body, content_type, mtime=None):
+        headers = f"Content-Type: {content_type}\r\n"
+        if mtime is not None:
+            headers += f"Last-Modified: {email.utils.formatdate(mtime, usegmt=True)}\r\n"
+        self.gzip_head = self.gzip_body = None
+        if len(body) >= GZIP_MIN_SIZE and (content_type.startswith("text/") or content_type.split(";")[0] in COMPRESSIBLE_TYPES):
+            packed = gzip.compress(body, 6)
+            if len(packed) < len(body) * 0.9:
+                headers += "Vary: Accept-Encoding\r\n"
+                self.gzip_body = packed
+                self.gzip_head = f"{headers}Content-Encoding: gzip\r\nContent-Length: {len(packed)}\r\n\r\n".encode("latin-1")
+        self.head = f"{headers}Content-Length: {len(body)}\r\n\r\n".encode("latin-1")
+        self.body = body
+        self.size = len(self.head) + len(body) + (len(self.gzip_head) + len(self.gzip_body) if self.gzip_body else 0)
+
+
+class ResponseCache:
+    '''
+    LRU of CachedResponses for the archive's hot files (the showcase bundle and runtime, locale json, fonts, graph
+    responses, tiles many viewers look at) bounded by budget bytes, compressed copies and headers included.  Keys are
+    ArchiveIndex entries, so a file that changed gets a new key when the index is rebuilt.  One per server process.
+    '''
+
+    def __init__(self, budget, max_entry=None):
+        self.budget = budget
+        self.max_entry = max_entry or budget // 8  # a file bigger than this would push out too much of the rest
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.loading = {}  # key: Event set once the request reading and compressing it is done
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_served = 0
+
+    def get(self, key):
+        with self.lock:
+            response = self.entries.get(key)
+            if response is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return response
+
+    def load(self, key, loader):
+        '''
+        The response for key, calling loader() for it on a miss.  Viewers opening a tour together all miss on the same
+        files, the first one loads each and the rest wait for it rather than reading and compressing it again.
+        '''
+        response = self.get(key)
+        if response is not None:
+            return response
+        with self.lock:
+            event = self.loading.get(key)
+            if event is None:
+                self.loading[key] = threading.Event()
+        if event is not None:
+            event.wait()
+            with self.lock:
+                response = self.entries.get(key)
+            # not cached when it failed to load or was too big, then every request loads its own
+            return response if response is not None else loader()
+        try:
+            response = loader()
+            if response is not None:
+                self.put(key, response)
+            return response
+        finally:
+            with self.lock:
+                self.loading.pop(key).set()
+
+    def put(self, key, response):
+        if response.size > self.max_entry:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            self.entries[key] = response
+            self.size += response.size
+            while self.size > self.budget:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.size
+                self.evictions += 1
+
+    def served(self, length):
+        with self.lock:
+            self.bytes_served += length
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"pid": os.getpid(), "entries": len(self.entries), "bytes": self.size, "budget": self.budget, "hits": self.hits,
+                    "misses": self.misses, "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                    "evictions": self.evictions, "bytes_served": self.bytes_served}
+
+
+RESPONSE_CACHE = None
+
+
+class OurSimpleHTTPRequestHandler(SimpleHTTPRequestHandler):
+    # HTTP/1.1 so the viewer's tile requests reuse their connections, every response sends a Content-Length for that
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes, Nagle would hold the body back for the client's delayed ack
+    disable_nagle_algorithm = True
+    timeout = SERVER_IDLE_TIMEOUT
+    route = None  # the SERVER_INDEX entry do_GET or do_HEAD resolved the request to, for send_head
+
+    def send_error(self, code, message=None):
+        if code == 404:
+            logging.warning(
+                f'404 error: {self.path} may not be downloading everything right')
+        SimpleHTTPRequestHandler.send_error(self, code, message)
 
+    def sendBytes(self, body, content_type="application/json"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def sendCached(self, response):
+        # Status line, headers and body in one write
+        if response.gzip_body is not None and acceptsGzip(self.headers.get("Accept-Encoding", "")):
+            head, body = response.gzip_head, response.gzip_body
+        else:
+            head, body = response.head, response.body
+        self.log_request(200)
+        if self.command == "HEAD":
+            body = b""
+        self.wfile.write(b"".join((f"{self.protocol_version} 200 OK\r\nServer: {self.version_string()}\r\nDate: {self.date_time_string()}\r\n".encode("latin-1"), head, body)))
+        if RESPONSE_CACHE:
+            RESPONSE_CACHE.served(len(body))
+
+    def loadResponse(self, route):
+        # The response for an index entry, from the cache if there is one; None if the file can't be read
+        changed = []
+
+        def read():
+            file_path, size, mtime, ctype = route
+            try:
+                with open(file_path, "rb") as f:
+                    fs = os.fstat(f.fileno())
+                    body = f.read()
+            except OSError:
+                SERVER_INDEX.stale.value = True
+                return None
+            if fs.st_size != size or fs.st_mtime != mtime:
+                # changed since it was indexed, sent as it is now but not cached under the old entry
+                SERVER_INDEX.stale.value = True
+                changed.append(CachedResponse(body, ctype, fs.st_mtime))
+                return None
+            return CachedResponse(body, ctype, mtime)
+        response = RESPONSE_CACHE.load(route, read) if RESPONSE_CACHE else read()
+        return response or (changed[0] if changed else None)
+
+    def sendGraph(self, option_name):
+        # The archived response for a graph query, else the template from graph_posts, else an empty answer
+        route = SERVER_INDEX.graphs.get(option_name)
+        if route:
+            response = self.loadResponse(route)
+            if response is not None:
+                self.sendCached(response)
+                return f"graph of operationName: {option_name} served from {route[0]}"
+        if option_name in GRAPH_DATA_REQ:
+            template = lambda: CachedResponse(GRAPH_DATA_REQ[option_name].encode('utf-8'), "application/json")
+            self.sendCached(RESPONSE_CACHE.load(("template", option_name), template) if RESPONSE_CACHE else template())
+            return f"graph of operationName: {option_name} served from template"
+        self.sendBytes(b'{"data": "empty"}')
+        return f"graph for operationName: {option_name} we don't know how to handle, but likely could add support, returning empty instead"
 
+    def do_GET(self):
+        if self.path == CACHE_STATS_PATH:
+            self.sendBytes(json.dumps(RESPONSE_CACHE.stats() if RESPONSE_CACHE else {}).encode())
+            return
+        if self.path == "/api/v2/config/showcase":
+            self.sendBytes(b'{"application": "showcase", "application_version": "25.11.3"}')
+            return
+        if self.path.startswith("/geoip/"):
+            self.sendBytes(b'{"city":"Unknown","country_code":"US","country_name":"United States"}')
+            return
+        if self.path.endswith("logo-white-r.svg"):
+            self.sendBytes(b'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 1 1"></svg>', "image/svg+xml")
+            return
+
+        raw_path, _, query = self.path.partition('?')
+        if raw_path.startswith("/api/v1/jsonstore/model/plugins/"):
+            self.sendBytes(b'{}')
+            return
+        # persisted queries come as GETs with the operation in the query string
+        if raw_path.startswith("/api/mp/models/graph"):
+            option_name = urllib.parse.parse_qs(query).get("operationName", [None])[0]
+            logging.info(f'Handling a graph GET on {self.path}: {self.sendGraph(option_name)}')
+            return
+
+        self.resolveRoute(raw_path, query)
         SimpleHTTPRequestHandler.do_GET(self)
         return
 
+    def do_HEAD(self):
+        # Resolved like a GET so HEAD answers for exactly the files GET would serve, aliases and fallbacks included
+        raw_path, _, query = self.path.partition('?')
+        self.resolveRoute(raw_path, query)
+        SimpleHTTPRequestHandler.do_HEAD(self)
+
+    def resolveRoute(self, raw_path, query):
+        # Points self.path at the archive file answering the request and keeps its index entry for send_head
+        url, self.route, redirect_msg = SERVER_INDEX.resolve(raw_path, query)
+        if redirect_msg is not None:
+            logging.info(
+                f'Redirecting {self.path} => {url} as {redirect_msg}')
+            self.path = url
+
+    def send_head(self):
+        # Files in the index are answered from it, from memory when they fit the response cache, anything else
+        # (directory listings, 404s) the usual way
+        route, self.route = self.route, None
+        if route is None:
+            return SimpleHTTPRequestHandler.send_head(self)
+        file_path, size, mtime, ctype = route
+        if self.notModified(mtime):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+        if RESPONSE_CACHE and size <= RESPONSE_CACHE.max_entry:
+            response = self.loadResponse(route)
+            if response is not None:
+                self.sendCached(response)
+                return None
+        try:
+            f = open(file_path, 'rb')
+        except OSError:
+            SERVER_INDEX.stale.value = True
+            return SimpleHTTPRequestHandler.send_head(self)
+        try:
+            # the open file is what gets sent, so its Content-Length is checked against it rather than trusting the index
+            fs = os.fstat(f.fileno())
+            if fs.st_size != size or fs.st_mtime != mtime:
+                SERVER_INDEX.stale.value = True
+                size, mtime = fs.st_size, fs.st_mtime
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-type", ctype)
+            self.send_header("Content-Length", str(size))
+            self.send_header("Last-Modified", self.date_time_string(mtime))
+            self.end_headers()
+            return f
+        except:
+            f.close()
+            raise
+
+    def notModified(self, mtime):
+        since = self.headers.get("If-Modified-Since")
+        if not since or "If-None-Match" in self.headers:
+            return False
+        try:
+            since = email.utils.parsedate_to_datetime(since)
+        except (TypeError, IndexError, OverflowError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=datetime.timezone.utc)
+        return int(mtime) <= since.timestamp()
+
     def do_POST(self):
         post_msg = None
+        # the body is read whatever the path, on a kept-alive connection it would otherwise be taken for the next request
+        post_body = self.rfile.read(int(self.headers.get('content-length') or 0))
         try:
-            if self.path == "/api/mp/models/graph":
-                self.send_response(200)
-                self.end_headers()
-                content_len = int(self.headers.get('content-length'))
-                post_body = self.rfile.read(content_len).decode('utf-8')
+            if self.path == "/client_log":
+                self.sendBytes(b'')
+                try:
+                    log_data = json.loads(post_body)
+                    logging.info(f"CLIENT LOG [{log_data.get('level')}]: {log_data.get('message')}")
+                except ValueError:
+                    logging.info(f"CLIENT LOG (raw): {post_body.decode('utf-8', 'replace')}")
+                return
+            if self.path.startswith("/api/v1/event"):
+                self.sendBytes(b'{}')
+                return
+            if self.path.startswith("/api/mp/models/graph") or self.path.startswith("/api/mp/accounts/graph"):
                 json_body = json.loads(post_body)
-                option_name = json_body["operationName"]
-                if option_name in GRAPH_DATA_REQ:
-                    file_path = f"api/mp/models/graph_{option_name}.json"
-                    if os.path.exists(file_path):
-                        with open(file_path, "r", encoding="UTF-8") as f:
-                            self.wfile.write(f.read().encode('utf-8'))
-                            post_msg = f"graph of operationName: {option_name} we are handling internally"
-                            return
-                    else:
-                        post_msg = f"graph for operationName: {option_name} we don't know how to handle, but likely could add support, returning empty instead"
-
-                self.wfile.write(bytes('{"data": "empty"}', "utf-8"))
+                post_msg = self.sendGraph(json_body.get("operationName"))
                 return
         except Exception as error:
             post_msg = f"Error trying to handle a post request of: {str(error)} this should not happen"
-            pass
+            self.close_connection = True
+            try:
+                # a client waiting on a kept-alive connection needs a status line, not a silent close
+                self.send_error(500, f"Error handling the post request: {error}")
+            except OSError:
+                pass  # the client is gone already
+            return
         finally:
             if post_msg is not None:
                 logging.info(
@@ -814,19 +2934,241 @@ class OurSimpleHTTPRequestHandler(SimpleHTTPRequestHandler):
 
         self.do_GET()  # just treat the POST as a get otherwise:)
 
+    def copyfile(self, source, outputfile):
+        # Archive files go to the socket with sendfile rather than through a Python buffer
+        self.connection.sendfile(source)
+
     def guess_type(self, path):
-        res = SimpleHTTPRequestHandler.guess_type(self, path)
-        if res == "text/html":
-            return "text/html; charset=UTF-8"
-        return res
+        return contentType(path)
+
+
+class ReplayServer(ThreadingHTTPServer):
+    '''
+    Serves an archive with a thread per connection.  Opening a tour sends hundreds of tile requests at once over the
+    browser's handful of kept-alive connections, so the listen backlog is sized for the burst rather than the default 5.
+    With reuse_port several processes bind the same port and the kernel spreads new connections between them.
+    '''
+    allow_reuse_address = True
+    daemon_threads = False  # stop() waits for the connection threads
+    request_queue_size = 1024
+
+    def __init__(self, server_address, RequestHandlerClass, reuse_port=False):
+        self.reuse_port = reuse_port
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+        ThreadingHTTPServer.__init__(self, server_address, RequestHandlerClass)
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        ThreadingHTTPServer.server_bind(self)
+
+    def process_request(self, request, client_address):
+        with self.connections_lock:
+            self.connections.add(request)
+        ThreadingHTTPServer.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        with self.connections_lock:
+            self.connections.discard(request)
+        ThreadingHTTPServer.shutdown_request(self, request)
+
+    def stop(self):
+        '''
+        Answers the connections already queued on the listening socket, ends kept-alive connections once their current
+        request is answered and returns when all of them are closed.  Call after serve_forever has returned.
+        '''
+        self.socket.setblocking(False)
+        while True:
+            try:
+                request, client_address = self.socket.accept()
+            except OSError:
+                break
+            self.process_request(request, client_address)
+        with self.connections_lock:
+            connections = list(self.connections)
+        for request in connections:
+            # an idle connection reads end of file and closes, a busy one does so after its response
+            try:
+                request.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
+        self.server_close()
+
+
+def runWorker(host, port):
+    httpd = ReplayServer((host, port), OurSimpleHTTPRequestHandler, reuse_port=True)
+    # shutdown() waits for serve_forever, which runs in this thread, so it is called from another
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=httpd.shutdown).start())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C reaches the whole group, the master stops the workers
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGALRM, signal.SIG_IGN)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, WorkerPool.SIGNALS)
+    httpd.serve_forever()
+    httpd.stop()
+    if RESPONSE_CACHE:
+        logging.info(f"Worker {os.getpid()} response cache: {RESPONSE_CACHE.stats()}")
+
+
+class WorkerPool:
+    '''
+    Pre-forks count processes that each run a ReplayServer on the same port.  SIGHUP, or the archive changing, is a
+    graceful reload: the archive index is rebuilt, a new set of workers started on it and the old ones told to stop,
+    they finish the requests they have and exit.  SIGTERM or Ctrl+C stops every worker the same way.  A worker that dies is replaced.
+    '''
+    SIGNALS = {signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGALRM} if hasattr(signal, "SIGHUP") else set()
+
+    def __init__(self, host, port, count):
+        self.host = host
+        self.port = port
+        self.count = count
+        self.workers = {}  # pid: start time
+        self.retiring = set()
+        self.running = True
+        self.failed = False
+
+    def spawn(self):
+        # signals stay blocked until the child has swapped the pool's handlers for its own
+        signal.pthread_sigmask(signal.SIG_BLOCK, self.SIGNALS)
+        try:
+            pid = os.fork()
+            if pid == 0:
+                code = 1
+                try:
+                    runWorker(self.host, self.port)
+                    code = 0
+                except BaseException:
+                    logging.exception(f"Worker {os.getpid()} failed")
+                finally:
+                    os._exit(code)
+        finally:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, self.SIGNALS)
+        self.workers[pid] = time.monotonic()
+
+    def fill(self):
+        while self.running and len(self.workers) < self.count:
+            self.spawn()
+
+    def retire(self):
+        for pid in self.workers:
+            os.kill(pid, signal.SIGTERM)
+        self.retiring.update(self.workers)
+        self.workers = {}
+
+    def reload(self):
+        global SERVER_INDEX
+        if not self.running:
+            return
+        SERVER_INDEX = ArchiveIndex()
+        self.retire()
+        self.fill()
+        logging.info(f"Reloaded, {len(self.retiring)} workers finishing their requests, {len(self.workers)} started")
+
+    def stop(self):
+        self.running = False
+        self.retire()
+
+    def run(self):
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.reload())
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: self.stop())
+        watchArchive(self.reload)
+        self.fill()
+        logging.info(f"Started {self.count} workers on port {self.port}")
+        while self.workers or self.retiring:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                continue
+            started = self.workers.pop(pid, None)
+            if started is None or not self.running:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            if code != 0 and time.monotonic() - started < WORKER_START_GRACE:
+                logging.error(f"Worker {pid} failed on start with exit code {code}, stopping")
+                self.failed = True
+                self.stop()
+                continue
+            logging.warning(f"Worker {pid} exited with code {code}, starting another")
+            self.fill()
+        return not self.failed
+
+
+def reindexArchive():
+    # SIGHUP on a single process server, requests being answered keep the index they started with
+    global SERVER_INDEX
+    SERVER_INDEX = ArchiveIndex()
+    if RESPONSE_CACHE:
+        RESPONSE_CACHE.clear()  # entries of files that changed would never be looked up again
+    logging.info(f"Reloaded the archive index, {len(SERVER_INDEX.files)} files")
+
+
+def watchArchive(reload):
+    # Checks the indexed directories every ARCHIVE_WATCH_INTERVAL on SIGALRM, the checks run in the main thread like SIGHUP
+    if not ARCHIVE_WATCH_INTERVAL or not hasattr(signal, "setitimer"):
+        return
+
+    def check(signum, frame):
+        if SERVER_INDEX.changed():
+            logging.info("Archive changed, reloading")
+            reload()
+    signal.signal(signal.SIGALRM, check)
+    signal.setitimer(signal.ITIMER_REAL, ARCHIVE_WATCH_INTERVAL, ARCHIVE_WATCH_INTERVAL)
+
+
+def prepareServer(directory):
+    '''
+    Indexes the archive in directory, which becomes the current directory, and sets up the response cache.
+    '''
+    global SERVER_INDEX, RESPONSE_CACHE
+    os.chdir(directory)
+    SERVER_INDEX = ArchiveIndex()
+    logging.info(f"Indexed {len(SERVER_INDEX.files)} files and {len(SERVER_INDEX.graphs)} graph operations")
+    if SERVER_INDEX.showcase:
+        logging.info(f"Using showcase file: {SERVER_INDEX.showcase}")
+    RESPONSE_CACHE = ResponseCache(RESPONSE_CACHE_SIZE) if RESPONSE_CACHE_SIZE else None
+
+
+def serveArchive(directory, host="", port=8080, workers=1):
+    '''
+    Serves the archive in directory until interrupted, used by both the server mode here and server.py.
+    With workers above 1 that many processes are pre-forked to share the port.
+    '''
+    prepareServer(directory)
+    print(f"View in browser: http://{host or 'localhost'}:{port}")
+    if workers > 1:
+        if hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT"):
+            return WorkerPool(host, port, workers).run()
+        logging.warning("--workers needs fork and SO_REUSEPORT, serving from a single process")
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: reindexArchive())
+    watchArchive(reindexArchive)
+    httpd = ReplayServer((host, port), OurSimpleHTTPRequestHandler)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    httpd.stop()
+    if RESPONSE_CACHE:
+        logging.info(f"Response cache: {RESPONSE_CACHE.stats()}")
+    return True
 
 PROXY = False
 ADVANCED_DOWNLOAD_ALL = False
+VERIFY_MANIFEST = False
+UPDATE_ARCHIVE = False
+DOWNLOAD_PLAN = None  # DownloadPlan of a --plan run, nothing but discovery is downloaded while set
+SHARD = None  # (index, count) from --shard i/K, the part of a --from-plan run this process downloads
+BLOB_STORE_DIR = None  # None uses downloads/.blobs, False disables the store
+MISSING_CACHE_TTL = 7 * 24 * 3600  # seconds a 404 is remembered, 0 disables the cache
 
 GRAPH_DATA_REQ = {}
 
-def injectClientLogger(content):
-    logger_script = """
+# Forwards the browser console to server.py's /client_log
+CLIENT_LOGGER_SCRIPT = """
     <script>
     (function() {
         var oldLog = console.log;
@@ -859,59 +3201,182 @@ def injectClientLogger(content):
     })();
     </script>
     """
-    return content.replace("<head>", "<head>" + logger_script)
 
-def injectGraphData(content, pageid):
-    logging.info("Injecting graph data into index.html...")
-    match = re.search(r'window\.MP_PREFETCHED_MODELDATA = parseJSON\("(.+?)"\);', content, re.DOTALL)
-    if not match:
-        logging.warning("Could not find MP_PREFETCHED_MODELDATA in index.html for injection")
-        return content
 
-    json_str = match.group(1).replace('\\"', '"').replace('\\\\', '\\')
-    try:
-        data = json.loads(json_str)
-    except json.JSONDecodeError as e:
-        logging.error(f"Error decoding JSON from index.html: {e}")
-        return content
+def indexRewriter(pageid, staticbase, threeMinUrl=None):
+    '''
+    Rules for the show page saved as index.html: static and cdn urls point at the local server, the page redirects to
+    ?m=<pageid> which the server relies on, links never expire and the client logger is injected.
+    '''
+    redirect = f'if (window.location.search != "?m={pageid}") {{ document.location.search = "?m={pageid}"; }}'
+    rules = [
+        ("static-base", staticbase, "http://localhost:8080/"),
+        # the lookbehind keeps a page that already has the redirect from getting a second one
+        ("page-redirect", re.compile(r'(?<!\};)window\.MP_PREFETCHED_MODELDATA'), f"{redirect};window.MP_PREFETCHED_MODELDATA"),
+        # Use absolute URL for localhost to avoid Invalid URL errors in client
+        ("cdn-1", '"https://cdn-1.matterport.com/', '"http://localhost:8080/'),
+        ("fastly", '"https://mp-app-prod.global.ssl.fastly.net/', '"http://localhost:8080/'),
+        ("events", '"https://events.matterport.com/', '"http://localhost:8080/'),
+        ("cdn-2", '"https://cdn-2.matterport.com/', '"http://localhost:8080/'),
+        ("valid-until", re.compile(r'validUntil":\s*"(?!2099-01-01T)20\d{2}-\d{2}-\d{2}T'), 'validUntil":"2099-01-01T'),
+        ("client-logger", re.compile(r'<head>(?!\s*<script>\s*\(function\(\) \{\s*var oldLog)'), "<head>" + CLIENT_LOGGER_SCRIPT),
+    ]
+    if threeMinUrl:
+        # Prepend ./ to the path for local module loading
+        rules.append(("three", threeMinUrl, "./" + threeMinUrl.replace('https://static.matterport.com/', '')))
+    return Rewriter(rules)
 
-    if "queries" not in data:
-        data["queries"] = {}
 
-    # Iterate over all graph_*.json files in the expected download location
-    # Note: We are currently in the download directory when this runs? 
-    # No, downloadPage changes dir at the end? No, it doesn't change dir until the server starts or we need to be careful.
-    # The files are in api/mp/models/ relative to current working dir if we are inside the page dir.
-    # Let's check where we are. downloadPage creates page_root_dir but doesn't chdir into it until later?
-    # Actually downloadPage does NOT chdir. It uses os.path.join.
-    
-    models_dir = os.path.join("api", "mp", "models")
-    if os.path.exists(models_dir):
-        graph_files = glob.glob(os.path.join(models_dir, "graph_*.json"))
-        logging.info(f"Found {len(graph_files)} graph files to inject.")
-
-        for file_path in graph_files:
-            filename = os.path.basename(file_path)
-            op_name = filename.replace("graph_", "").replace(".json", "")
-            
-            with open(file_path, "r", encoding="utf-8") as f:
-                try:
-                    op_data = json.load(f)
-                    data["queries"][op_name] = op_data
-                    logging.info(f"Injected {op_name}")
-                except json.JSONDecodeError:
-                    logging.warning(f"Failed to decode {filename}, skipping.")
+GRAPH_DATA_START = 'window.MP_PREFETCHED_MODELDATA = parseJSON("'
+GRAPH_DATA_STRING = re.compile(r'[^"\\]*+(?:\\.[^"\\]*+)*+')
+GRAPH_DATA_REWRITE = "graph-data"  # rewrites table entry for index.html, its sha256 says whether the recorded offsets still hold
+
+
+def loadJSON(text):
+    return orjson.loads(text) if orjson else json.loads(text)
+
+
+def dumpJSON(value):
+    return orjson.dumps(value).decode("UTF-8") if orjson else json.dumps(value, separators=(",", ":"))
+
+
+def jsString(text):
+    # Escaped for the inside of the "..." that parseJSON is called with, escaping is per character so pieces can be escaped apart
+    return json.dumps(text)[1:-1]
+
+
+def graphSignature(file):
+    stat = os.stat(file)
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def injectGraphData(pageid):
+    '''
+    Puts every archived graph_*.json into the MP_PREFETCHED_MODELDATA blob of index.html so the viewer finds the queries
+    without asking the server.  The first injection into a page decodes the blob and writes each query separately, the
+    manifest keeps where each one landed and the graph file's mtime and size; later calls splice in just the queries whose
+    files changed and leave the rest of the page, and the other queries, undecoded.
+    '''
+    index = jobPath("index.html")
+    models_dir = jobPath(os.path.join("api", "mp", "models"))
+    files = {os.path.basename(file)[len("graph_"):-len(".json")]: file for file in sorted(glob.glob(os.path.join(models_dir, "graph_*.json")))}
+    if not files:
+        logging.warning(f"No graph files in {models_dir} to inject")
+        return
+    with open(index, "rb") as f:
+        raw = f.read()
+    content = raw.decode("UTF-8")
+    signatures = {operation: graphSignature(file) for operation, file in files.items()}
+    job = currentJob()
+    manifest = job.manifest if job else None
+    spans = None
+    if manifest and manifest.rewritten(index) == (GRAPH_DATA_REWRITE, hashlib.sha256(raw).hexdigest()):
+        spans = manifest.injections()
+    if spans is not None and spans.keys() == files.keys():
+        changed = [operation for operation in files if spans[operation][0] != signatures[operation]]
+        if not changed:
+            logging.info("Graph data in index.html is up to date")
+            return
+        content, spans = spliceGraphData(content, spans, {operation: files[operation] for operation in changed}, signatures)
+        logging.info(f"Updated {', '.join(changed)} in index.html")
     else:
-        logging.warning(f"Models directory {models_dir} not found during injection")
+        injected = fullGraphData(content, files, signatures)
+        if injected is None:
+            return
+        content, spans = injected
+        logging.info(f"Injected {len(files)} graph queries into index.html")
+    out = AtomicFile(index, shared=False)
+    out.write(content.encode("UTF-8"))
+    out.commit()
+    if manifest:
+        manifest.recordInjections(spans)
+        manifest.recordRewrite(index, GRAPH_DATA_REWRITE, out.sha256.hexdigest())
+
+
+def graphValue(file):
+    # The archived response compacted, graph files are stored as the server pretty prints them
+    with open(file, "rb") as f:
+        return jsString(dumpJSON(loadJSON(f.read())))
+
+
+def spliceGraphData(content, spans, changed, signatures):
+    '''
+    Replaces the spans of the changed queries in one join, moving the recorded offsets of everything after them.
+    '''
+    parts = []
+    pos = 0
+    shift = 0
+    moved = {}
+    for operation, (signature, offset, length) in sorted(spans.items(), key=lambda item: item[1][1]):
+        if operation in changed:
+            try:
+                value = graphValue(changed[operation])
+            except ValueError:
+                logging.warning(f"Failed to decode graph_{operation}.json, keeping the copy already in index.html")
+                moved[operation] = (signatures[operation], offset + shift, length)
+                continue
+            parts.append(content[pos:offset])
+            parts.append(value)
+            pos = offset + length
+            moved[operation] = (signatures[operation], offset + shift, len(value))
+            shift += len(value) - length
+        else:
+            moved[operation] = (signature, offset + shift, length)
+    parts.append(content[pos:])
+    return "".join(parts), moved
+
+
+def fullGraphData(content, files, signatures):
+    '''
+    Rebuilds the blob with the page's own data and every graph query, returns (content, spans) or None if there is no blob.
+    '''
+    start = content.find(GRAPH_DATA_START)
+    if start < 0:
+        logging.warning("Could not find MP_PREFETCHED_MODELDATA in index.html for injection")
+        return None
+    start += len(GRAPH_DATA_START)
+    end = GRAPH_DATA_STRING.match(content, start).end()
+    try:
+        data = loadJSON(json.loads(f'"{content[start:end]}"'))
+    except ValueError as e:
+        logging.error(f"Error decoding JSON from index.html: {e}")
+        return None
+    queries = data.pop("queries", None) or {}
+    for operation in files:
+        queries.pop(operation, None)
+    # The page's data with "queries" moved last, then every graph query written on its own so its offset can be kept
+    head = dumpJSON(data)[:-1] + ("," if data else "") + '"queries":{'
+    head += "".join(f"{dumpJSON(operation)}:{dumpJSON(value)}," for operation, value in queries.items())
+    parts = [content[:start], jsString(head)]
+    offset = start + len(parts[1])
+    spans = {}
+    separator = ""
+    for operation, file in files.items():
+        try:
+            value = graphValue(file)
+        except ValueError:
+            logging.warning(f"Failed to decode graph_{operation}.json, skipping.")
+            continue
+        key = jsString(f"{separator}{dumpJSON(operation)}:")
+        parts += [key, value]
+        spans[operation] = (signatures[operation], offset + len(key), len(value))
+        offset += len(key) + len(value)
+        separator = ","
+    parts += [jsString("}}"), content[end:]]
+    return "".join(parts), spans
 
-    new_json_str = json.dumps(data).replace('\\', '\\\\').replace('"', '\\"')
-    return content.replace(match.group(1), new_json_str)
 
 def openDirReadGraphReqs(path, pageId):
+    graph_data_req = {}
     for root, dirs, filenames in os.walk(path):
         for file in filenames:
+            if not file.endswith(".json"):
+                continue
             with open(os.path.join(root, file), "r", encoding="UTF-8") as f:
-                GRAPH_DATA_REQ[file.replace(".json", "")] = f.read().replace("[MATTERPORT_MODEL_ID]",pageId)             
+                # graph_ prefixed copies are keyed by their operationName too
+                key = file[:-len(".json")]
+                graph_data_req[key[len("graph_"):] if key.startswith("graph_") else key] = f.read().replace("[MATTERPORT_MODEL_ID]",pageId)
+    return graph_data_req
 
 
 def getUrlOpener(use_proxy):
@@ -937,15 +3402,58 @@ def getCommandLineArg(name, has_value):
 
 if __name__ == "__main__":
     ADVANCED_DOWNLOAD_ALL = getCommandLineArg("--advanced-download", False)
+    VERIFY_MANIFEST = getCommandLineArg("--verify", False)
+    UPDATE_ARCHIVE = getCommandLineArg("--update", False)
+    BLOB_STORE_DIR = getCommandLineArg("--blob-store", True) or None
+    if getCommandLineArg("--no-blob-store", False):
+        BLOB_STORE_DIR = False
+    MISSING_CACHE_TTL = float(getCommandLineArg("--missing-ttl", True) or MISSING_CACHE_TTL / 86400) * 86400
     PROXY = getCommandLineArg("--proxy", True)
+    MAX_CONNECTIONS = int(getCommandLineArg("--max-connections", True) or MAX_CONNECTIONS)
+    CHUNK_SIZE = int(getCommandLineArg("--chunk-size", True) or CHUNK_SIZE)
+    batch = getCommandLineArg("--batch", True)
+    concurrent_tours = int(getCommandLineArg("--jobs", True) or 4)
+    plan_file = getCommandLineArg("--plan", True)
+    if plan_file:
+        DOWNLOAD_PLAN = DownloadPlan(plan_file)
+    from_plan = getCommandLineArg("--from-plan", True)
+    shard = getCommandLineArg("--shard", True)
+    if shard:
+        SHARD = parseShard(shard)
+    merge = getCommandLineArg("--merge", True)
+    METRICS_TEXTFILE = getCommandLineArg("--metrics-textfile", True) or None
+    SERVER_WORKERS = int(getCommandLineArg("--workers", True) or SERVER_WORKERS)
+    cache_size = getCommandLineArg("--cache-size", True)
+    if cache_size:
+        RESPONSE_CACHE_SIZE = int(float(cache_size) * 1024 * 1024)
     OUR_OPENER = getUrlOpener(PROXY)
     urllib.request.install_opener(OUR_OPENER)
     pageId = ""
     if len(sys.argv) > 1:
         pageId = getPageId(sys.argv[1])
-    openDirReadGraphReqs("graph_posts", pageId)
-    if len(sys.argv) == 2:
+    GRAPH_DATA_REQ = openDirReadGraphReqs("graph_posts", pageId)
+    if merge:
+        conflicts = sum(mergeShards(pageid) for pageid in readPlan(merge))
+        sys.exit(1 if conflicts else 0)
+    elif from_plan:
+        planned = readPlan(from_plan, SHARD)
+        failed = downloadBatch(list(planned), concurrent_tours, planned)
+        if DOWNLOAD_ENGINE:
+            DOWNLOAD_ENGINE.close()
+        sys.exit(1 if failed else 0)
+    elif batch:
+        failed = downloadBatch(readBatchList(batch), concurrent_tours)
+        if DOWNLOAD_PLAN:
+            DOWNLOAD_PLAN.close()
+        if DOWNLOAD_ENGINE:
+            DOWNLOAD_ENGINE.close()
+        sys.exit(1 if failed else 0)
+    elif len(sys.argv) == 2:
         initiateDownload(pageId)
+        if DOWNLOAD_PLAN:
+            DOWNLOAD_PLAN.close()
+        if DOWNLOAD_ENGINE:
+            DOWNLOAD_ENGINE.close()
     elif len(sys.argv) == 4:
         os.chdir(getPageId(pageId))
         try:
@@ -954,15 +3462,6 @@ if __name__ == "__main__":
             logging.basicConfig(filename='server.log', level=logging.DEBUG,  format='%(asctime)s %(levelname)-8s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
         logging.info("Server started up")
         
-        # Determine showcase name for server
-        showcase_files = [f for f in os.listdir("js") if f.startswith("showcase.") and f.endswith(".js")]
-        if showcase_files:
-            SHOWCASE_INTERNAL_NAME = showcase_files[0]
-
-
-        print("View in browser: http://" + sys.argv[2] + ":" + sys.argv[3])
-        httpd = HTTPServer(
-            (sys.argv[2], int(sys.argv[3])), OurSimpleHTTPRequestHandler)
-        httpd.serve_forever()
+        sys.exit(0 if serveArchive(".", sys.argv[2], int(sys.argv[3]), SERVER_WORKERS) else 1)
     else:
-        print(f"Usage:\n\tFirst Download: matterport-dl.py [url_or_page_id]\n\tThen launch the server 'matterport-dl.py [url_or_page_id] 127.0.0.1 8080' and open http://127.0.0.1:8080 in a browser\n\t--proxy 127.0.0.1:1234 -- to have it use this web proxy\n\t--advanced-download -- Use this option to try and download the cropped files for dollhouse/floorplan support")
+        print(f"Usage:\n\tFirst Download: matterport-dl.py [url_or_page_id]\n\tOr download many: matterport-dl.py --batch tours.txt|id1,id2,... [--jobs 4]\n\tThen launch the server 'matterport-dl.py [url_or_page_id] 127.0.0.1 8080' and open http://127.0.0.1:8080 in a browser\n\tAdd --workers 4 to the server to pre-fork 4 processes sharing the port, send the server SIGHUP to reload them gracefully\n\tAdd --cache-size 64 to the server to change how many MB of hot files each server process keeps in memory, 0 to disable\n\tOr plan a download without fetching the bulk of it: matterport-dl.py [url_or_page_id] --plan plan.jsonl, then later matterport-dl.py --from-plan plan.jsonl\n\tOr split a plan across machines: matterport-dl.py --from-plan plan.jsonl --shard 1/4 on each, then matterport-dl.py --merge plan.jsonl\n\t--proxy 127.0.0.1:1234 -- to have it use this web proxy\n\t--max-connections 256 -- how many requests to keep in flight at once\n\t--chunk-size 65536 -- bytes buffered per download while streaming it to disk\n\t--blob-store /path -- keep the shared content-addressed store of downloaded files here instead of downloads/.blobs\n\t--no-blob-store -- write each archive's files directly instead of hardlinking them from the shared store\n\t--missing-ttl 7 -- days to remember urls that returned 404 and skip them on later runs, 0 to always retry them\n\t--update -- revalidate an existing archive with conditional requests and fetch only the sweeps and mesh that changed\n\t--metrics-textfile /path/matterport_dl.prom -- also write the run's metrics in Prometheus textfile format\n\t--verify -- re-hash every file in the archive's download manifest and download again any that are missing or changed\n\t--advanced-download -- Use this option to try and download the cropped files for dollhouse/floorplan support")